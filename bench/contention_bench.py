@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+
+"""Benchmark for several processes using the same framework database at once.
+
+Each process runs a number of hooks, each one opening the database, reemitting
+deferred events, emitting a new event and committing, as a unit agent does when
+hooks and actions run concurrently. Run from the repository root as:
+
+    python3 bench/contention_bench.py --processes 4 --hooks 200
+"""
+
+import argparse
+import multiprocessing
+import sys
+import time
+import tempfile
+import shutil
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from juju.framework import Framework, SQLiteStorage, Event, EventBase, Object
+
+
+class BenchEvent(EventBase):
+    pass
+
+
+class BenchNotifier(Object):
+    foo = Event(BenchEvent)
+
+
+class BenchObserver(Object):
+
+    defer = False
+
+    def on_foo(self, event):
+        if self.defer:
+            event.defer()
+
+
+def run_hooks(filename, worker, hooks, durability, busy_timeout):
+    """Run hooks against the database, returning the latency of each and the number of failures."""
+    latencies = []
+    failures = 0
+    for i in range(hooks):
+        start = time.perf_counter()
+        try:
+            framework = Framework(None, storage=SQLiteStorage(filename, durability, busy_timeout))
+            try:
+                # Each worker uses its own objects, as separate charms would.
+                pub = BenchNotifier(framework, str(worker))
+                obs = BenchObserver(framework, str(worker))
+                framework.observe(pub.foo, obs)
+                framework.reemit()
+                # Every third event is deferred until the next hook.
+                obs.defer = i % 3 == 0
+                pub.foo.emit()
+                framework.commit()
+            finally:
+                framework.close()
+        except Exception as e:
+            failures += 1
+            print(f"worker {worker}: {e}", file=sys.stderr)
+            continue
+        latencies.append(time.perf_counter() - start)
+    return latencies, failures
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark processes contending for one framework database.")
+    parser.add_argument("--processes", type=int, default=4, help="number of concurrent processes (default: 4)")
+    parser.add_argument("--hooks", type=int, default=100, help="hooks run by each process (default: 100)")
+    parser.add_argument("--durability", default="wal-normal", choices=list(SQLiteStorage.DURABILITY_PROFILES),
+                        help="storage durability profile (default: wal-normal)")
+    parser.add_argument("--busy-timeout", type=float, default=5.0,
+                        help="seconds to wait for the database to be unlocked (default: 5)")
+    args = parser.parse_args()
+
+    tmpdir = Path(tempfile.mkdtemp())
+    try:
+        filename = tmpdir / "contention.data"
+        # Created upfront, so processes don't race to set up the schema.
+        Framework(filename, durability=args.durability).close()
+        jobs = [(filename, worker, args.hooks, args.durability, args.busy_timeout)
+                for worker in range(args.processes)]
+        start = time.perf_counter()
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.starmap(run_hooks, jobs)
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(tmpdir)
+
+    latencies = sorted(latency for worker_latencies, _ in results for latency in worker_latencies)
+    failures = sum(failures for _, failures in results)
+    print(f"{args.processes} processes, {args.hooks} hooks each, {args.durability} durability")
+    print(f"  throughput: {len(latencies) / elapsed:8.1f} hooks/s")
+    if latencies:
+        print(f"  p50:        {percentile(latencies, 0.50) * 1e3:8.2f} ms")
+        print(f"  p99:        {percentile(latencies, 0.99) * 1e3:8.2f} ms")
+        print(f"  max:        {latencies[-1] * 1e3:8.2f} ms")
+    print(f"  failures:   {failures:8d}")
+
+
+if __name__ == "__main__":
+    main()
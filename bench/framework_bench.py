@@ -0,0 +1,468 @@
+#!/usr/bin/python3
+
+"""Benchmarks for the framework hot paths.
+
+Run from the repository root. Results are printed and optionally saved as a
+JSON baseline, which later runs may be compared against:
+
+    python3 bench/framework_bench.py run --output /tmp/framework-baseline.json
+    python3 bench/framework_bench.py compare /tmp/framework-baseline.json
+
+Comparing runs the benchmarks again unless a second results file is provided,
+and exits with an error status if any case got slower than the baseline by
+more than the threshold, and by more than the noise floor of the case, or if
+any stored size grew by more than the threshold. Timings are only comparable
+when taken on the same machine, so baselines aren't kept in the repository.
+Take one before making changes, and compare against it.
+"""
+
+import argparse
+import json
+import marshal
+import pickle
+import platform
+import statistics
+import sys
+import time
+import tempfile
+import shutil
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from juju.framework import Framework, Handle, Event, EventBase, Object, StoredState
+from juju.framework import SQLiteStorage, MemoryStorage, LogStorage, MarshalCodec, PickleCodec
+from juju.framework import _parse_handle_path
+from juju.charm import Charm
+
+
+class BenchEvent(EventBase):
+    pass
+
+
+class BenchNotifier(Object):
+    foo = Event(BenchEvent)
+
+
+class BenchObserver(Object):
+
+    defer = False
+
+    def on_foo(self, event):
+        if self.defer:
+            event.defer()
+
+
+class BenchState(Object):
+    state = StoredState()
+
+
+class BenchBase(Object):
+    foo = Event(BenchEvent)
+
+
+# A deep class hierarchy with events spread along it.
+BenchDeep = BenchBase
+for _i in range(10):
+    BenchDeep = type(f"BenchDeep{_i}", (BenchDeep,), {f"event{_i}": Event(BenchEvent)})
+
+
+# {name: (func, description, noise_floor)}, in the order they run.
+CASES = {}
+
+# {name: (func, description)} for sizes in bytes, in the order they're measured.
+SIZES = {}
+
+# Seconds per call by which a case must get slower to be reported as a
+# regression, whatever the ratio, unless the case sets its own.
+NOISE_FLOOR = 5e-6
+
+
+def case(name, description, noise_floor=NOISE_FLOOR):
+    def register(func):
+        CASES[name] = (func, description, noise_floor)
+        return func
+    return register
+
+
+def size(name, description):
+    def register(func):
+        SIZES[name] = (func, description)
+        return func
+    return register
+
+
+def timeit(func, number, repeat=15, setup=None):
+    """Return the median time per call of func over repeat runs of number calls each.
+
+    One more run is done first and not measured, to warm up caches.
+    """
+    times = []
+    for i in range(repeat + 1):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        seconds = (time.perf_counter() - start) / number
+        if i:
+            times.append(seconds)
+    return statistics.median(times)
+
+
+def memory_framework():
+    return Framework(None, storage=MemoryStorage())
+
+
+def observed_notifier(framework, observers, defer=False):
+    pub = BenchNotifier(framework, "pub")
+    for i in range(observers):
+        obs = BenchObserver(framework, str(i))
+        obs.defer = defer
+        framework.observe(pub.foo, obs)
+    return pub
+
+
+for _observers in (1, 10, 1000):
+    def _bench_emit(tmpdir, observers=_observers):
+        framework = memory_framework()
+        pub = observed_notifier(framework, observers)
+        return timeit(pub.foo.emit, max(10, 1000 // observers))
+    case(f"emit_observers_{_observers}", f"BoundEvent.emit with {_observers} observers",
+         noise_floor=5e-3 if _observers == 1000 else 5e-5)(_bench_emit)
+
+
+for _unrelated in (1, 10, 100, 1000):
+    def _bench_emit_unrelated(tmpdir, unrelated=_unrelated):
+        framework = memory_framework()
+        pub = observed_notifier(framework, 1)
+        for i in range(unrelated):
+            other = BenchNotifier(framework, f"other{i}")
+            framework.observe(other.foo, BenchObserver(framework, f"other{i}"))
+        return timeit(pub.foo.emit, 1000)
+    case(f"emit_unrelated_observers_{_unrelated}",
+         f"BoundEvent.emit with 1 observer among {_unrelated} unrelated ones",
+         noise_floor=5e-5)(_bench_emit_unrelated)
+
+
+@case("emit_sqlite_observers_10", "BoundEvent.emit with 10 observers on SQLiteStorage", noise_floor=5e-4)
+def bench_emit_sqlite(tmpdir):
+    framework = Framework(tmpdir / "emit.data")
+    pub = observed_notifier(framework, 10)
+    seconds = timeit(pub.foo.emit, 100)
+    framework.close()
+    return seconds
+
+
+@case("charm_on_emit", "Repeated charm.on.install.emit()", noise_floor=5e-5)
+def bench_charm_on_emit(tmpdir):
+    framework = memory_framework()
+    charm = Charm(framework, None)
+    framework.observe(charm.on.install, BenchObserver(framework, "charm").on_foo)
+    return timeit(charm.on.install.emit, 1000)
+
+
+for _backlog in (1000, 10000):
+    def _bench_reemit(tmpdir, backlog=_backlog):
+        # Backlog of deferred events with 10 observers each, deferred again on every pass.
+        framework = memory_framework()
+        pub = observed_notifier(framework, 10, defer=True)
+        for i in range(backlog // 10):
+            pub.foo.emit()
+        return timeit(framework.reemit, 1, repeat=5) / backlog
+    case(f"reemit_backlog_{_backlog}", f"Framework.reemit per notice, with {_backlog} deferred notices")(_bench_reemit)
+
+
+def deep_handle(depth):
+    handle = None
+    for i in range(depth):
+        handle = Handle(handle, f"kind{i}", str(i))
+    return handle
+
+
+@case("handle_path_depth_20", "Handle.path on a handle 20 levels deep")
+def bench_handle_path(tmpdir):
+    handle = deep_handle(20)
+    return timeit(lambda: handle.path, 100000)
+
+
+@case("handle_create_depth_20", "Handle creation under a parent 19 levels deep")
+def bench_handle_create(tmpdir):
+    parent = deep_handle(19)
+    return timeit(lambda: Handle(parent, "kind", "key"), 100000)
+
+
+@case("handle_from_path_cached", "Handle.from_path for a recently parsed path 20 levels deep")
+def bench_handle_from_path_cached(tmpdir):
+    path = deep_handle(20).path
+    return timeit(lambda: Handle.from_path(path), 100000)
+
+
+@case("handle_from_path_siblings", "Handle.from_path for distinct events under a parent 19 levels deep")
+def bench_handle_from_path_siblings(tmpdir):
+    parent_path = deep_handle(19).path
+    paths = [f"{parent_path}/foo[{i}]" for i in range(10000)]
+    def parse_all():
+        for path in paths:
+            Handle.from_path(path)
+    return timeit(parse_all, 1, setup=_parse_handle_path.cache_clear) / len(paths)
+
+
+@case("stored_state_write", "StoredState attribute write", noise_floor=5e-5)
+def bench_stored_state_write(tmpdir):
+    framework = memory_framework()
+    obj = BenchState(framework, "1")
+    def write():
+        obj.state.n = 1
+    return timeit(write, 1000)
+
+
+@case("stored_dict_nested_write", "Nested StoredDict mutation", noise_floor=5e-5)
+def bench_stored_dict_nested(tmpdir):
+    framework = memory_framework()
+    obj = BenchState(framework, "1")
+    obj.state.dict = {"a": {"b": {}}}
+    def write():
+        obj.state.dict["a"]["b"]["c"] = 1
+    return timeit(write, 1000)
+
+
+@case("stored_state_commit_100_writes", "100 StoredState writes in a batch, then commit, on SQLiteStorage",
+      noise_floor=5e-4)
+def bench_stored_state_commit(tmpdir):
+    framework = Framework(tmpdir / "stored.data")
+    obj = BenchState(framework, "1")
+    def hook():
+        with framework.batch():
+            for i in range(100):
+                obj.state.n = i
+    seconds = timeit(hook, 20)
+    framework.close()
+    return seconds
+
+
+for _units in (20, 5000):
+    def _bench_stored_state_commit_large(tmpdir, units=_units):
+        framework = Framework(tmpdir / "stored.data")
+        obj = BenchState(framework, "1")
+        obj.state.relation = stored_state_payload(units)
+        obj.state.n = 0
+        framework.commit()
+        def hook():
+            obj.state.n += 1
+            framework.commit()
+        seconds = timeit(hook, 50)
+        framework.close()
+        return seconds
+    def _bench_stored_state_commit_nested(tmpdir, units=_units):
+        framework = Framework(tmpdir / "stored.data")
+        obj = BenchState(framework, "1")
+        obj.state.relation = stored_state_payload(units)
+        framework.commit()
+        unit = obj.state.relation["units"]["app/3"]
+        def hook():
+            unit["settings"]["weight"] += 1
+            framework.commit()
+        seconds = timeit(hook, 50)
+        framework.close()
+        return seconds
+    case(f"stored_state_commit_{_units}_units",
+         f"One StoredState write and commit, next to {_units} units of stored state, on SQLiteStorage",
+         noise_floor=5e-4)(
+        _bench_stored_state_commit_large)
+    case(f"stored_state_commit_nested_{_units}_units",
+         f"One nested write within {_units} units of stored state and commit, on SQLiteStorage",
+         noise_floor=5e-4)(
+        _bench_stored_state_commit_nested)
+
+
+@case("object_create", "Object construction for a new emitter")
+def bench_object_create(tmpdir):
+    framework = memory_framework()
+    keys = iter(range(10**9))
+    return timeit(lambda: BenchNotifier(framework, str(next(keys))), 10000)
+
+
+@case("object_create_deep", "Object construction for a new emitter with a deep class hierarchy", noise_floor=1e-5)
+def bench_object_create_deep(tmpdir):
+    framework = memory_framework()
+    keys = iter(range(10**9))
+    return timeit(lambda: BenchDeep(framework, str(next(keys))), 10000)
+
+
+def stored_state_payload(units):
+    """Stored state shaped like typical per-unit relation bookkeeping."""
+    return {
+        "leader": True,
+        "config_hash": "3f2a9c0d1b7e4f6a8c5d2e1f0a9b8c7d",
+        "units": {
+            f"app/{i}": {
+                "address": f"10.0.{i // 256}.{i % 256}",
+                "ready": i % 3 != 0,
+                "ports": [8080, 8443, 9100],
+                "settings": {"role": "replica", "weight": i, "tags": ["a", "b"]},
+            } for i in range(units)
+        },
+        "pending": [f"app/{i}" for i in range(0, units, 7)],
+    }
+
+
+class TwoPassPickleCodec(PickleCodec):
+    """PickleCodec as it was before validating in the same pass, for comparison."""
+
+    def encode(self, data):
+        _ = marshal.dumps(data)
+        return pickle.dumps(data)
+
+
+for _codec in (PickleCodec, MarshalCodec, TwoPassPickleCodec):
+    for _units in (20, 500):
+        def _bench_encode(tmpdir, codec=_codec(), units=_units):
+            data = stored_state_payload(units)
+            return timeit(lambda: codec.encode(data), 100)
+        def _bench_decode(tmpdir, codec=_codec(), units=_units):
+            raw_data = codec.encode(stored_state_payload(units))
+            return timeit(lambda: codec.decode(raw_data), 100)
+        def _size_encoded(codec=_codec(), units=_units):
+            return len(codec.encode(stored_state_payload(units)))
+        name = _codec.__name__.lower()
+        noise_floor = 5e-5 if _units == 20 else 5e-4
+        case(f"{name}_encode_{_units}_units", f"{_codec.__name__}.encode of {_units} units of stored state",
+             noise_floor)(_bench_encode)
+        case(f"{name}_decode_{_units}_units", f"{_codec.__name__}.decode of {_units} units of stored state",
+             noise_floor)(_bench_decode)
+        size(f"{name}_size_{_units}_units", f"{_codec.__name__} snapshot of {_units} units of stored state")(
+            _size_encoded)
+
+
+def hook_framework(tmpdir, name):
+    if name.startswith("log"):
+        return Framework(None, storage=LogStorage(tmpdir / name, sync=name == "log-sync"))
+    return Framework(tmpdir / f"{name}.data", durability=name)
+
+
+for _name in list(SQLiteStorage.DURABILITY_PROFILES) + ["log-sync", "log-nosync"]:
+    def _bench_hook(tmpdir, name=_name):
+        framework = hook_framework(tmpdir, name)
+        pub = observed_notifier(framework, 1)
+        def hook():
+            pub.foo.emit()
+            framework.commit()
+        seconds = timeit(hook, 50)
+        framework.close()
+        return seconds
+    case(f"hook_{_name}", f"One emit and commit with {_name} storage", noise_floor=5e-4)(_bench_hook)
+
+
+@case("framework_setup_sqlite", "Framework creation and close on SQLiteStorage", noise_floor=1e-3)
+def bench_framework_setup_sqlite(tmpdir):
+    paths = iter(range(10**9))
+    return timeit(lambda: Framework(tmpdir / f"setup-{next(paths)}.data").close(), 50)
+
+
+@case("framework_setup_memory", "Framework creation and close on MemoryStorage", noise_floor=5e-5)
+def bench_framework_setup_memory(tmpdir):
+    return timeit(lambda: Framework(None, storage=MemoryStorage()).close(), 1000)
+
+
+def run(pattern=None):
+    results = {}
+    tmpdir = Path(tempfile.mkdtemp())
+    try:
+        for name, (func, description, noise_floor) in CASES.items():
+            if pattern and pattern not in name:
+                continue
+            casedir = tmpdir / name
+            casedir.mkdir()
+            seconds = func(casedir)
+            results[name] = seconds
+            print(f"{name:<36} {seconds * 1e6:12.3f} us  {description}")
+    finally:
+        shutil.rmtree(tmpdir)
+    sizes = {}
+    for name, (func, description) in SIZES.items():
+        if pattern and pattern not in name:
+            continue
+        sizes[name] = func()
+        print(f"{name:<36} {sizes[name]:12d} B   {description}")
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+        "sizes": sizes,
+    }
+
+
+def compare(baseline, current, threshold):
+    """Print how current results compare to baseline and return the names of regressions.
+
+    A case regressed if it's slower by more than the threshold ratio, and by
+    more than its noise floor in absolute terms. Sizes don't vary between runs,
+    so they regressed if they grew by more than the threshold ratio at all.
+    """
+    regressions = []
+    for name, seconds in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:<36} {seconds * 1e6:12.3f} us  (new)")
+            continue
+        ratio = seconds / base
+        noise_floor = CASES[name][2] if name in CASES else NOISE_FLOOR
+        flag = ""
+        if ratio > 1 + threshold and seconds - base > noise_floor:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<36} {base * 1e6:12.3f} us -> {seconds * 1e6:12.3f} us  {ratio:6.2f}x{flag}")
+    for name, size in current.get("sizes", {}).items():
+        base = baseline.get("sizes", {}).get(name)
+        if base is None:
+            print(f"{name:<36} {size:12d} B   (new)")
+            continue
+        ratio = size / base
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:<36} {base:12d} B  -> {size:12d} B   {ratio:6.2f}x{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the framework hot paths.")
+    subparsers = parser.add_subparsers(dest="command")
+    run_parser = subparsers.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--output", help="save results as JSON into this file")
+    run_parser.add_argument("--filter", help="only run cases with this in their name")
+    compare_parser = subparsers.add_parser("compare", help="compare results against a baseline")
+    compare_parser.add_argument("baseline", help="JSON file with baseline results")
+    compare_parser.add_argument("current", nargs="?", help="JSON file with current results (default: run now)")
+    compare_parser.add_argument("--threshold", type=float, default=0.25,
+                                help="slowdown ratio above which a case is a regression (default: 0.25)")
+    compare_parser.add_argument("--filter", help="only run cases with this in their name")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if args.current:
+            with open(args.current) as f:
+                current = json.load(f)
+        else:
+            current = run(args.filter)
+            print()
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} case(s) regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+    else:
+        results = run(getattr(args, "filter", None))
+        output = getattr(args, "output", None)
+        if output:
+            with open(output, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+                f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,23 @@
+import os
+import io
+import sys
+import copy
+import json
 import pickle
 import marshal
 import types
+import asyncio
+import inspect
 import sqlite3
 import collections
+import contextlib
+import functools
+import concurrent.futures
+import pathlib
+import struct
+import threading
+import time
+import zlib
 
 
 class Handle:
@@ -19,57 +34,94 @@ class Handle:
     under the same parent and kind may have the same key.
     """
 
+    __slots__ = ("_parent", "_kind", "_key", "_path", "_hash")
+
     def __init__(self, parent, kind, key):
         if parent and not isinstance(parent, Handle):
             parent = parent.handle
-        self.parent = parent
-        self.kind = kind
-        self.key = key
+        # Handles are immutable, so the path and hash are computed once here
+        # rather than walking the whole parent chain every time they're needed.
+        if parent:
+            if key:
+                path = f"{parent._path}/{kind}[{key}]"
+            else:
+                path = f"{parent._path}/{kind}"
+        else:
+            if key:
+                path = f"{kind}[{key}]"
+            else:
+                path = f"{kind}"
+        object.__setattr__(self, "_parent", parent)
+        object.__setattr__(self, "_kind", kind)
+        object.__setattr__(self, "_key", key)
+        object.__setattr__(self, "_path", path)
+        object.__setattr__(self, "_hash", hash(path))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"cannot set attribute '{name}': Handle is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"cannot delete attribute '{name}': Handle is immutable")
+
+    def __reduce__(self):
+        # Attributes can't be set after creation, so copies and unpickled
+        # handles are created anew instead.
+        return (Handle, (self._parent, self._kind, self._key))
 
     def nest(self, kind, key):
         return Handle(self, kind, key)
 
     def __hash__(self):
-        return hash((self.parent, self.kind, self.key))
+        return self._hash
 
     def __eq__(self, other):
-        return (self.parent, self.kind, self.key) == (other.parent, other.kind, other.key)
+        if not isinstance(other, Handle):
+            return NotImplemented
+        return self._hash == other._hash and self._path == other._path
 
     def __str__(self):
-        return self.path
+        return self._path
+
+    @property
+    def parent(self):
+        return self._parent
+
+    @property
+    def kind(self):
+        return self._kind
+
+    @property
+    def key(self):
+        return self._key
 
     @property
     def path(self):
-        # TODO Cache result and either clear cache when attributes change, or make it read-only.
-        if self.parent:
-            if self.key:
-                return f"{self.parent}/{self.kind}[{self.key}]"
-            else:
-                return f"{self.parent}/{self.kind}"
-        else:
-            if self.key:
-                return f"{self.kind}[{self.key}]"
-            else:
-                return f"{self.kind}"
+        return self._path
 
     @classmethod
     def from_path(cls, path):
-        handle = None
-        for pair in path.split("/"):
-            pair = pair.split("[")
-            good = False
-            if len(pair) == 1:
-                kind, key = pair[0], None
-                good = True
-            elif len(pair) == 2:
-                kind, key = pair
-                if key and key[-1] == ']':
-                    key = key[:-1]
-                    good = True
-            if not good:
-                raise RuntimeError("attempted to restore invalid handle path {path}")
-            handle = Handle(handle, kind, key)
-        return handle
+        return _parse_handle_path(path)
+
+
+# Number of parsed handle paths kept around by Handle.from_path. Deferred
+# events are reemitted in order, so even a small cache is hit by most rows.
+HANDLE_PATH_CACHE_SIZE = 1024
+
+@functools.lru_cache(maxsize=HANDLE_PATH_CACHE_SIZE)
+def _parse_handle_path(path):
+    # Parents are parsed through the same cache, so handles for events
+    # under the same emitter share a single parent chain. That's safe
+    # because handles are immutable.
+    parent_path, sep, pair = path.rpartition("/")
+    parent = _parse_handle_path(parent_path) if sep else None
+    kind, sep, key = pair.partition("[")
+    if not sep:
+        key = None
+    elif "[" in key or not key.endswith("]"):
+        raise RuntimeError(f"attempted to restore invalid handle path {path}")
+    else:
+        key = key[:-1]
+    return Handle(parent, kind, key)
 
 
 class EventBase:
@@ -112,32 +164,56 @@ class Event:
         if not isinstance(event_type, type) or not issubclass(event_type, EventBase):
             raise RuntimeError(f"Event requires a subclass of EventBase as an argument, got {event_type}")
         self.event_type = event_type
-        self.event_kind = {}
 
     def __get__(self, emitter, emitter_type=None):
         # This looks magic and is sort of magic, but it's also simple if
         # you understand what it does. The single goal here is to find
         # the attribute name that points to this Event, so that we can use
         # that as the event_kind. :)  (and thus on_<name>, etc).
-        event_kind = self.event_kind.get(emitter_type)
-        if not event_kind:
-            found_cls = None
-            for cls in emitter_type.__mro__:
-                for attr_name, attr_value in cls.__dict__.items():
-                    if attr_value is self:
-                        if event_kind:
-                            raise RuntimeError("Event({}) shared between {}.{} and {}.{}".format(
-                                self.event_type.__name__, found_cls.__name__, event_kind, cls.__name__, attr_name))
-                        found_cls = cls
-                        event_kind = attr_name
-                        self.event_kind[emitter_type] = event_kind
-            if not event_kind:
-                raise RuntimeError("Cannot find Event({}) attribute in type {}".format(self.event_type.__name__, emitter_type.__name__))
+        found = _event_table(emitter_type).get(self)
+        if not found:
+            raise RuntimeError("Cannot find Event({}) attribute in type {}".format(self.event_type.__name__, emitter_type.__name__))
+        found_cls, event_kind = found[0]
+        if len(found) > 1:
+            cls, attr_name = found[1]
+            raise RuntimeError("Event({}) shared between {}.{} and {}.{}".format(
+                self.event_type.__name__, found_cls.__name__, event_kind, cls.__name__, attr_name))
         if emitter is None:
             return self
         return BoundEvent(emitter, self.event_type, event_kind)
 
 
+def _event_table(emitter_type):
+    """Return the {event: [(cls, event_kind), ...]} table of Event attributes in emitter_type.
+
+    The table is computed once per type and then kept in the type itself.
+    Each list holds the (cls, attribute name) pairs where that same Event
+    is found, in MRO order, so more than one entry means it's being shared.
+    """
+    table = emitter_type.__dict__.get("_event_table")
+    if table is None:
+        table = {}
+        seen = set()
+        for cls in emitter_type.__mro__:
+            for attr_name, attr_value in cls.__dict__.items():
+                if attr_name in seen:
+                    # Overridden in a subclass.
+                    continue
+                seen.add(attr_name)
+                if isinstance(attr_value, Event):
+                    table.setdefault(attr_value, []).append((cls, attr_name))
+        emitter_type._event_table = table
+    return table
+
+
+def _forget_event_table(emitter_type):
+    """Drop the cached event table of emitter_type and of all its subclasses."""
+    if "_event_table" in emitter_type.__dict__:
+        del emitter_type._event_table
+    for subclass in emitter_type.__subclasses__():
+        _forget_event_table(subclass)
+
+
 class BoundEvent:
 
     def __init__(self, emitter, event_type, event_kind):
@@ -150,12 +226,58 @@ class BoundEvent:
 
         The current storage state is committed before and after each observer is notified.
         """
+        _check_observer_thread("emit events")
         framework = self.emitter.framework
-        # TODO This needs to be persisted.
-        framework._event_count += 1
-        key = str(framework._event_count)
-        event = self.event_type(Handle(self.emitter, self.event_kind, key), *args, **kwargs)
-        framework._emit(event)
+        framework._emit(self._create(framework, args, kwargs))
+
+    async def emit_async(self, *args, **kwargs):
+        """Emit event to all registered observers, running async observers concurrently.
+
+        See Framework.reemit_async for how observers are notified.
+        """
+        _check_observer_thread("emit events")
+        framework = self.emitter.framework
+        await framework._emit_async(self._create(framework, args, kwargs))
+
+    def _create(self, framework, args, kwargs):
+        key = framework._next_event_key()
+        # Events may be defined after the emitter is bound (see EventsBase.define_event),
+        # so make sure the type is known before it gets saved.
+        framework.register_type(self.event_type, self.emitter, self.event_kind)
+        return self.event_type(Handle(self.emitter, self.event_kind, key), *args, **kwargs)
+
+
+async def _gather_observers(calls):
+    """Run the coroutines of async observers concurrently, and wait for futures of parallel ones.
+
+    Returns what each of them returned or raised.
+    """
+    return await asyncio.gather(*(asyncio.wrap_future(call) if isinstance(call, concurrent.futures.Future) else call
+                                  for call in calls), return_exceptions=True)
+
+
+def _wait_observers(futures):
+    """Wait for the futures of parallel observers, returning what each of them returned or raised."""
+    concurrent.futures.wait(futures)
+    return [future.exception() or future.result() for future in futures]
+
+
+# Marks threads running parallel observers.
+_observer_thread = threading.local()
+
+
+def _init_observer_thread():
+    _observer_thread.parallel = True
+
+
+def _check_observer_thread(action):
+    """Raise RuntimeError if running a parallel observer, which must not do action.
+
+    This must be checked before anything is changed, so that nothing done by a
+    parallel observer ends up being persisted.
+    """
+    if getattr(_observer_thread, "parallel", False):
+        raise RuntimeError(f"cannot {action} from parallel observers")
 
 
 class HandleKind:
@@ -176,6 +298,10 @@ class Object:
 
     handle_kind = HandleKind()
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        _event_table(cls)
+
     def __init__(self, parent, key):
         kind = self.handle_kind
         if isinstance(parent, Framework):
@@ -188,13 +314,9 @@ class Object:
         # TODO This can probably be dropped, because the event type is only
         # really relevant if someone is either emitting the event or observing
         # it.
-        for cls in type(self).__mro__:
-            for attr_name, attr_value in cls.__dict__.items():
-                if isinstance(attr_value, Event):
-                    event_type = attr_value.event_type
-                    event_kind = attr_name
-                    emitter = self
-                    self.framework.register_type(event_type, emitter, event_kind)
+        for event, found in _event_table(type(self)).items():
+            for _, event_kind in found:
+                self.framework.register_type(event.event_type, self, event_kind)
 
         # TODO Detect conflicting handles here.
 
@@ -204,20 +326,33 @@ class EventsBase(Object):
 
     handle_kind = "on"
 
+    _attr_name = None
+
     def __init__(self, parent=None, key=None):
         if parent != None:
             super().__init__(parent, key)
 
+    def __set_name__(self, emitter_type, attr_name):
+        self._attr_name = attr_name
+
     def __get__(self, emitter, emitter_type):
         # Same type, different instance, more data. Doing this unusual construct
         # means people can subclass just this one class to have their own 'on'.
         if emitter is None:
             return self
-        return type(self)(emitter)
+        bound = type(self)(emitter)
+        # Binding is only done once per emitter. The bound instance is stored
+        # under the same attribute name, so later lookups find it directly in
+        # the emitter and never get here again.
+        attr_name = self._attr_name
+        if attr_name and getattr(emitter_type, attr_name, None) is self:
+            emitter.__dict__[attr_name] = bound
+        return bound
 
     @classmethod
     def define_event(cls, event_kind, event_type):
         setattr(cls, event_kind, Event(event_type))
+        _forget_event_table(cls)
 
 
 class NoSnapshotError(Exception):
@@ -240,83 +375,1108 @@ class NoTypeError(Exception):
 
 class SQLiteStorage:
 
-    def __init__(self, filename):
-        self._db = sqlite3.connect(str(filename), isolation_level="EXCLUSIVE")
-        self._setup()
+    # Each entry holds the statements that upgrade the schema from the
+    # version at that index to the next one. New changes must always be
+    # appended, so that existing databases are upgraded in place.
+    SCHEMA_MIGRATIONS = [
+        # 0 => 1: Initial tables.
+        [
+            "CREATE TABLE snapshot (handle TEXT PRIMARY KEY, data TEXT)",
+            "CREATE TABLE notice (sequence INTEGER PRIMARY KEY AUTOINCREMENT, event_path TEXT, observer_path TEXT, method_name TEXT)",
+        ],
+        # 1 => 2: Indexes for finding notices by event, in order, and for dropping them.
+        [
+            "CREATE INDEX notice_event ON notice (event_path)",
+            "CREATE INDEX notice_observer ON notice (event_path, observer_path, method_name)",
+        ],
+    ]
+
+    # Durability profiles trade the safety of committed data for commit
+    # latency. Each one holds the pragmas applied when the database is opened.
+    DURABILITY_PROFILES = {
+        # Rollback journal, synced on every commit. Survives power loss.
+        "strict": {
+            "journal_mode": "DELETE",
+            "synchronous": "FULL",
+            "cache_size": -2000,
+            "mmap_size": 0,
+        },
+        # Write-ahead log, synced on checkpoints only. Survives process crashes,
+        # but the most recent commits may be lost on power loss.
+        "wal-normal": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size": -8000,
+            "mmap_size": 64 * 1024 * 1024,
+        },
+        # Journal kept in memory and never synced. A crash in the middle of a
+        # commit may corrupt the database, so only use it for disposable data.
+        "ephemeral": {
+            "journal_mode": "MEMORY",
+            "synchronous": "OFF",
+            "cache_size": -8000,
+            "mmap_size": 64 * 1024 * 1024,
+        },
+    }
+
+    # Notices are streamed by sequenced_notices in pages of this many rows.
+    NOTICE_PAGE_SIZE = 100
+
+    # Delays in seconds between retries of statements that found the database
+    # locked by another connection, doubling from the first up to the last.
+    BUSY_RETRY_DELAY = 0.005
+    BUSY_RETRY_MAX_DELAY = 0.2
+
+    def __init__(self, filename, durability="strict", busy_timeout=5.0, read_only=False):
+        """Open the database at filename, creating it if necessary.
+
+        Other processes may use the same database concurrently. Only one of them
+        may be changing it at a time, so the others wait for up to busy_timeout
+        seconds for the database to be unlocked, before failing with
+        sqlite3.OperationalError.
+
+        With read_only set, the database is opened for inspection only, and must
+        exist already. Neither the schema nor the durability profile are changed.
+        """
+        pragmas = self.DURABILITY_PROFILES.get(durability)
+        if pragmas is None:
+            raise RuntimeError(f"unknown storage durability profile: {durability}")
+        self._busy_timeout = busy_timeout
+        self._statements = None # {method_name: count}, when stats are enabled.
+        self._streams = {} # {id(dropped): dropped}, see sequenced_notices.
+        if read_only:
+            uri = pathlib.Path(filename).resolve().as_uri() + "?mode=ro"
+            self._db = sqlite3.connect(uri, uri=True, timeout=busy_timeout, isolation_level="EXCLUSIVE")
+            self._check_schema()
+            return
+        self._db = sqlite3.connect(str(filename), timeout=busy_timeout, isolation_level="EXCLUSIVE")
+        try:
+            for name, value in pragmas.items():
+                self._retry_busy(self._db.execute, f"PRAGMA {name}={value}")
+            self._setup()
+        except BaseException:
+            self._db.close()
+            raise
+
+    def begin(self):
+        """Start a transaction, unless one is in progress already.
+
+        Transactions are exclusive, so other connections can't start one until
+        it's committed or rolled back. Transactions start implicitly with the first
+        change, so this is only needed for what's read to be consistent with what's
+        changed afterwards, even while other processes use the same database.
+        """
+        if not self._db.in_transaction:
+            self._retry_busy(self._db.execute, "BEGIN EXCLUSIVE")
+
+    def _read(self, sql, parameters=()):
+        if self._db.in_transaction:
+            return self._db.execute(sql, parameters)
+        return self._retry_busy(self._db.execute, sql, parameters)
+
+    def _write(self, sql, parameters, many=False):
+        self.begin()
+        if many:
+            return self._db.executemany(sql, parameters)
+        return self._db.execute(sql, parameters)
+
+    def _retry_busy(self, execute, *args):
+        """Call execute with args, retrying while the database is locked by another connection.
+
+        SQLite waits on its own for the database to be unlocked, but gives up right
+        away when waiting could deadlock, so the statement is retried with backoff
+        until busy_timeout expires since it was first tried. This must only be used
+        outside of transactions, as within one the whole transaction would have to
+        be redone.
+        """
+        deadline = time.monotonic() + self._busy_timeout
+        delay = self.BUSY_RETRY_DELAY
+        while True:
+            try:
+                return execute(*args)
+            except sqlite3.OperationalError as e:
+                now = time.monotonic()
+                if "is locked" not in str(e) or now >= deadline:
+                    raise
+            time.sleep(min(delay, deadline - now))
+            delay = min(delay * 2, self.BUSY_RETRY_MAX_DELAY)
+
+    def _schema_version(self):
+        c = self._db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name IN ('snapshot', 'schema')")
+        tables = {row[0] for row in c.fetchall()}
+        if "schema" in tables:
+            c.execute("SELECT version FROM schema")
+            return c.fetchone()[0], True
+        # Databases created before the schema table existed are at version 1.
+        return (1 if "snapshot" in tables else 0), False
+
+    def _check_schema(self):
+        version, _ = self._schema_version()
+        if not 0 < version <= len(self.SCHEMA_MIGRATIONS):
+            self._db.close()
+            raise RuntimeError(f"cannot open storage with schema version {version} read-only")
 
     def _setup(self):
-        c = self._db.execute("BEGIN")
-        c.execute("SELECT count(name) FROM sqlite_master WHERE type='table' AND name='snapshot'")
-        if c.fetchone()[0] == 0:
-            # Keep in mind what might happen if the process dies somewhere below.
-            # The system must not be rendered permanently broken by that.
-            self._db.execute("CREATE TABLE snapshot (handle TEXT PRIMARY KEY, data TEXT)")
-            self._db.execute("CREATE TABLE notice (sequence INTEGER PRIMARY KEY AUTOINCREMENT, event_path TEXT, observer_path TEXT, method_name TEXT)")
-            self._db.commit()
+        # Keep in mind what might happen if the process dies somewhere below.
+        # The system must not be rendered permanently broken by that. All
+        # changes happen in a single transaction, including the version bump.
+        c = self._retry_busy(self._db.execute, "BEGIN EXCLUSIVE")
+        version, versioned = self._schema_version()
+        if not versioned:
+            c.execute("CREATE TABLE schema (version INTEGER)")
+            c.execute("INSERT INTO schema VALUES (?)", (version,))
+        if version > len(self.SCHEMA_MIGRATIONS):
+            self._db.rollback()
+            self._db.close()
+            raise RuntimeError(f"storage schema version {version} is newer than supported version {len(self.SCHEMA_MIGRATIONS)}")
+        if version < len(self.SCHEMA_MIGRATIONS):
+            for statements in self.SCHEMA_MIGRATIONS[version:]:
+                for statement in statements:
+                    c.execute(statement)
+            c.execute("UPDATE schema SET version=?", (len(self.SCHEMA_MIGRATIONS),))
+        self._db.commit()
+
+    def enable_stats(self):
+        """Start counting the statements executed per method, and return the counts.
+
+        Batched methods count one statement per notice.
+        """
+        self._statements = collections.Counter()
+        return self._statements
+
+    def disable_stats(self):
+        self._statements = None
 
     def close(self):
         self._db.close()
 
     def commit(self):
+        if self._statements is not None:
+            self._statements["commit"] += 1
         self._db.commit()
 
-    # There's commit but no rollback. For abort to be supported, we'll need logic that
-    # can rollback decisions made by third-party code in terms of the internal state
-    # of objects that have been snapshotted, and hooks to let them know about it and
-    # take the needed actions to undo their logic until the last snapshot.
-    # This is doable but will increase significantly the chances for mistakes.
+    # Rolling back only undoes changes in storage. Third-party code may have made
+    # decisions based on the rolled back data, and objects that were snapshotted
+    # may still hold it in memory. The framework only restores the objects it
+    # manages itself (see Framework.batch), so use this with care.
+    def rollback(self):
+        self._db.rollback()
 
     def save_snapshot(self, handle_path, snapshot_data):
-        self._db.execute("REPLACE INTO snapshot VALUES (?, ?)", (handle_path, snapshot_data))
+        if self._statements is not None:
+            self._statements["save_snapshot"] += 1
+        self._write("REPLACE INTO snapshot VALUES (?, ?)", (handle_path, snapshot_data))
 
     def load_snapshot(self, handle_path):
-        c = self._db.cursor()
-        c.execute("SELECT data FROM snapshot WHERE handle=?", (handle_path,))
+        if self._statements is not None:
+            self._statements["load_snapshot"] += 1
+        c = self._read("SELECT data FROM snapshot WHERE handle=?", (handle_path,))
         row = c.fetchone()
         if row:
             return row[0]
         return None
 
     def drop_snapshot(self, handle_path):
-        self._db.execute("DELETE FROM snapshot WHERE handle=?", (handle_path,))
+        if self._statements is not None:
+            self._statements["drop_snapshot"] += 1
+        self._write("DELETE FROM snapshot WHERE handle=?", (handle_path,))
 
     def save_notice(self, event_path, observer_path, method_name):
-        self._db.execute("INSERT INTO notice VALUES (NULL, ?, ?, ?)", (event_path, observer_path, method_name))
+        if self._statements is not None:
+            self._statements["save_notice"] += 1
+        self._write("INSERT INTO notice VALUES (NULL, ?, ?, ?)", (event_path, observer_path, method_name))
 
     def drop_notice(self, event_path, observer_path, method_name):
-        self._db.execute("DELETE FROM notice WHERE event_path=? AND observer_path=? AND method_name=?", (event_path, observer_path, method_name))
+        if self._statements is not None:
+            self._statements["drop_notice"] += 1
+        self._write("DELETE FROM notice WHERE event_path=? AND observer_path=? AND method_name=?", (event_path, observer_path, method_name))
+        for dropped in self._streams.values():
+            dropped.add((event_path, observer_path, method_name))
+
+    def save_notices(self, notices):
+        """Save all (event_path, observer_path, method_name) notices in order."""
+        if self._statements is not None:
+            notices = list(notices)
+            self._statements["save_notices"] += len(notices)
+        self._write("INSERT INTO notice VALUES (NULL, ?, ?, ?)", notices, many=True)
+
+    def drop_notices(self, notices):
+        """Drop all (event_path, observer_path, method_name) notices."""
+        if self._statements is not None or self._streams:
+            notices = list(notices)
+        if self._statements is not None:
+            self._statements["drop_notices"] += len(notices)
+        self._write("DELETE FROM notice WHERE event_path=? AND observer_path=? AND method_name=?", notices, many=True)
+        for dropped in self._streams.values():
+            dropped.update(notices)
 
     def notices(self, event_path):
+        for sequence, *notice in self.sequenced_notices(event_path):
+            yield tuple(notice)
+
+    def sequenced_notices(self, event_path, after=0):
+        """Yield (sequence, event_path, observer_path, method_name) for notices in order.
+
+        Only notices for event_path are considered, if provided, and only the
+        ones saved after the notice with the given sequence.
+
+        Notices may be saved and dropped while iterating. Notices saved after
+        the iteration started aren't seen, and dropped ones are skipped.
+        """
+        # Rather than keeping a cursor open while the table changes under it, notices
+        # are fetched in pages, each one continuing after the last sequence seen and
+        # bounded by the last sequence when the iteration started.
+        if self._statements is not None:
+            self._statements["sequenced_notices"] += 1
+        last_sequence = self._read("SELECT MAX(sequence) FROM notice").fetchone()[0]
+        if last_sequence is None:
+            return
         if event_path:
-            c = self._db.execute("SELECT event_path, observer_path, method_name FROM notice WHERE event_path=? ORDER BY sequence", (event_path,))
+            query = "SELECT sequence, event_path, observer_path, method_name FROM notice WHERE event_path=? AND sequence>? AND sequence<=? ORDER BY sequence LIMIT ?"
+            params = [event_path, after, last_sequence, self.NOTICE_PAGE_SIZE]
         else:
-            c = self._db.execute("SELECT event_path, observer_path, method_name FROM notice ORDER BY sequence")
-        while True:
-            rows = c.fetchmany()
-            if not rows:
+            query = "SELECT sequence, event_path, observer_path, method_name FROM notice WHERE sequence>? AND sequence<=? ORDER BY sequence LIMIT ?"
+            params = [after, last_sequence, self.NOTICE_PAGE_SIZE]
+        # Notices dropped since the current page was fetched.
+        dropped = set()
+        self._streams[id(dropped)] = dropped
+        try:
+            while True:
+                if self._statements is not None:
+                    self._statements["sequenced_notices"] += 1
+                rows = self._read(query, params).fetchall()
+                dropped.clear()
+                for row in rows:
+                    if dropped and row[1:] in dropped:
+                        continue
+                    yield row
+                if len(rows) < self.NOTICE_PAGE_SIZE:
+                    break
+                params[-3] = rows[-1][0]
+        finally:
+            del self._streams[id(dropped)]
+
+    def count_notices(self, event_path, after=0):
+        """Return how many notices sequenced_notices would yield."""
+        if self._statements is not None:
+            self._statements["count_notices"] += 1
+        if event_path:
+            c = self._read("SELECT COUNT(*) FROM notice WHERE event_path=? AND sequence>?", (event_path, after))
+        else:
+            c = self._read("SELECT COUNT(*) FROM notice WHERE sequence>?", (after,))
+        return c.fetchone()[0]
+
+
+class PreCommitEvent(EventBase):
+    """Events emitted by the framework right before a commit is made.
+
+    Objects may observe it to persist data they hold in memory at the last
+    possible moment, so that many changes are saved as a single snapshot.
+    """
+
+    def defer(self):
+        raise RuntimeError("cannot defer framework events")
+
+
+class FrameworkEvents(EventsBase):
+    pre_commit = Event(PreCommitEvent)
+
+
+class MemoryStorage:
+    """Storage kept entirely in memory, with the same interface as SQLiteStorage.
+
+    Nothing is ever written to disk, so this is meant for tests and short-lived
+    tooling. Changes that aren't committed are discarded on close, as with
+    SQLiteStorage, so the same storage may be handed to a new Framework to
+    observe what a later process would see.
+    """
+
+    def __init__(self):
+        self._snapshots = {} # {handle_path: snapshot_data}
+        self._notices = collections.OrderedDict() # {event_path: OrderedDict({sequence: (observer_path, method_name)})}
+        self._notice_sequences = {} # {event_path: {(observer_path, method_name): [sequence]}}
+        self._sequence = 0
+        self._committed_sequence = 0
+        self._undo = [] # [(undo_function, args)]
+
+    def close(self):
+        self.rollback()
+
+    def begin(self):
+        # Only used by a single process, so there's nothing to lock.
+        pass
+
+    def commit(self):
+        self._undo = []
+        self._committed_sequence = self._sequence
+
+    def rollback(self):
+        touched = set()
+        for func, args in reversed(self._undo):
+            func(*args)
+            if func == self._restore_notice:
+                touched.add(args[0])
+        self._undo = []
+        self._sequence = self._committed_sequence
+        # Restored notices were appended, so put them back in sequence order.
+        for event_path in touched:
+            notices = self._notices.get(event_path)
+            if notices:
+                self._notices[event_path] = collections.OrderedDict(sorted(notices.items()))
+
+    def _restore_snapshot(self, handle_path, snapshot_data):
+        if snapshot_data is None:
+            self._snapshots.pop(handle_path, None)
+        else:
+            self._snapshots[handle_path] = snapshot_data
+
+    def _restore_notice(self, event_path, sequence, notice):
+        notices = self._notices.get(event_path)
+        if notice is None:
+            notice = notices.pop(sequence)
+            sequences = self._notice_sequences[event_path]
+            sequences[notice].remove(sequence)
+            if not sequences[notice]:
+                del sequences[notice]
+            if not notices:
+                del self._notices[event_path]
+                del self._notice_sequences[event_path]
+        else:
+            if notices is None:
+                notices = self._notices[event_path] = collections.OrderedDict()
+                self._notice_sequences[event_path] = {}
+            notices[sequence] = notice
+            self._notice_sequences[event_path].setdefault(notice, []).append(sequence)
+
+    def save_snapshot(self, handle_path, snapshot_data):
+        self._undo.append((self._restore_snapshot, (handle_path, self._snapshots.get(handle_path))))
+        self._snapshots[handle_path] = snapshot_data
+
+    def load_snapshot(self, handle_path):
+        return self._snapshots.get(handle_path)
+
+    def drop_snapshot(self, handle_path):
+        snapshot_data = self._snapshots.pop(handle_path, None)
+        if snapshot_data is not None:
+            self._undo.append((self._restore_snapshot, (handle_path, snapshot_data)))
+
+    def save_notice(self, event_path, observer_path, method_name):
+        self._sequence += 1
+        notices = self._notices.get(event_path)
+        if notices is None:
+            notices = self._notices[event_path] = collections.OrderedDict()
+            self._notice_sequences[event_path] = {}
+        notice = (observer_path, method_name)
+        notices[self._sequence] = notice
+        self._notice_sequences[event_path].setdefault(notice, []).append(self._sequence)
+        self._undo.append((self._restore_notice, (event_path, self._sequence, None)))
+
+    def drop_notice(self, event_path, observer_path, method_name):
+        # Sequences are indexed per notice, so dropping one doesn't need to look
+        # at the other notices of the event.
+        sequences = self._notice_sequences.get(event_path)
+        if not sequences:
+            return
+        notice = (observer_path, method_name)
+        notices = self._notices[event_path]
+        for sequence in sequences.pop(notice, ()):
+            del notices[sequence]
+            self._undo.append((self._restore_notice, (event_path, sequence, notice)))
+        if not notices:
+            del self._notices[event_path]
+            del self._notice_sequences[event_path]
+
+    def save_notices(self, notices):
+        for notice in notices:
+            self.save_notice(*notice)
+
+    def drop_notices(self, notices):
+        for notice in notices:
+            self.drop_notice(*notice)
+
+    def notices(self, event_path):
+        for sequence, *notice in self.sequenced_notices(event_path):
+            yield tuple(notice)
+
+    def sequenced_notices(self, event_path, after=0):
+        # Work over a copy, so notices may be dropped and saved while iterating.
+        # Notices dropped in the meantime are skipped, and new ones aren't seen.
+        if event_path:
+            notices = self._notices.get(event_path)
+            if not notices:
+                return
+            rows = [(sequence, event_path, notice) for sequence, notice in notices.items() if sequence > after]
+        else:
+            rows = [(sequence, event_path, notice)
+                    for event_path, notices in self._notices.items()
+                    for sequence, notice in notices.items() if sequence > after]
+            rows.sort()
+        for sequence, event_path, (observer_path, method_name) in rows:
+            if sequence in self._notices.get(event_path, ()):
+                yield sequence, event_path, observer_path, method_name
+
+    def count_notices(self, event_path, after=0):
+        if event_path:
+            return sum(1 for sequence in self._notices.get(event_path, ()) if sequence > after)
+        return sum(1 for notices in self._notices.values() for sequence in notices if sequence > after)
+
+
+class LogStorage(MemoryStorage):
+    """Storage engine appending all changes to a log of checksummed records.
+
+    All data is kept in memory and indexed as in MemoryStorage, while changes
+    are recorded in the log when committed. Writes are therefore always
+    sequential appends to the active segment file in the provided directory.
+    Segments are rotated once they grow beyond segment_size, and after
+    compact_segments of them are closed, a background thread folds them into
+    a single base file holding just the live data.
+
+    When opened, the base file and the segments after it are replayed. A
+    transaction is only applied once its commit record is found, so if the
+    process died while committing, the torn transaction is discarded and the
+    log truncated back to the last commit, just as SQLite rolls back an
+    incomplete transaction.
+
+    Only one LogStorage may have a given directory open at any time.
+    """
+
+    # Records are framed by their payload length and CRC32 checksum.
+    _HEADER = struct.Struct("<II")
+
+    def __init__(self, directory, segment_size=4 * 1024 * 1024, compact_segments=4, sync=True):
+        super().__init__()
+        self._directory = pathlib.Path(directory)
+        self._segment_size = segment_size
+        self._compact_segments = compact_segments
+        self._sync = sync
+        self._pending = [] # [record_data]
+        self._lock = threading.Lock()
+        self._closed_segments = [] # [segment_number]
+        self._compactor = None
+        self._compact_error = None
+
+        self._directory.mkdir(parents=True, exist_ok=True)
+        self._recover()
+
+    def _path(self, prefix, number, suffix=".log"):
+        return self._directory / f"{prefix}-{number:08d}{suffix}"
+
+    def _numbers(self, prefix):
+        numbers = []
+        for path in self._directory.glob(f"{prefix}-*.log"):
+            try:
+                numbers.append(int(path.stem[len(prefix) + 1:]))
+            except ValueError:
+                pass
+        return sorted(numbers)
+
+    def _recover(self):
+        # Leftovers from a compaction that didn't finish are useless.
+        for path in self._directory.glob("base-*.tmp"):
+            path.unlink()
+
+        bases = self._numbers("base")
+        base = 0
+        if bases:
+            base = bases[-1]
+            path = self._path("base", base)
+            data = path.read_bytes()
+            if self._replay(data) != len(data):
+                raise RuntimeError(f"log storage base file {path} is corrupted")
+            for number in bases[:-1]:
+                self._path("base", number).unlink()
+
+        segments = []
+        torn = False
+        for number in self._numbers("segment"):
+            path = self._path("segment", number)
+            if number <= base or torn:
+                # Either already folded into the base, or written after a torn
+                # transaction, which can't happen in a healthy log since segments
+                # are only rotated after a commit is complete.
+                path.unlink()
+                continue
+            data = path.read_bytes()
+            committed = self._replay(data)
+            if committed != len(data):
+                with open(path, "r+b") as f:
+                    f.truncate(committed)
+                torn = True
+            segments.append(number)
+
+        MemoryStorage.commit(self)
+
+        number = segments.pop() if segments else base + 1
+        self._closed_segments = segments
+        self._open_segment(number)
+
+    def _replay(self, data):
+        """Apply all committed transactions in data and return the offset where the last one ends."""
+        committed = 0
+        transaction = []
+        for end, record in self._records(data):
+            if record[0] == "c":
+                for change in transaction:
+                    self._apply(change)
+                transaction = []
+                committed = end
+            else:
+                transaction.append(record)
+        return committed
+
+    def _records(self, data):
+        offset = 0
+        header_size = self._HEADER.size
+        while offset + header_size <= len(data):
+            length, checksum = self._HEADER.unpack_from(data, offset)
+            start = offset + header_size
+            end = start + length
+            if end > len(data):
+                break
+            payload = data[start:end]
+            if zlib.crc32(payload) != checksum:
                 break
-            for row in rows:
-                yield tuple(row)
+            try:
+                record = marshal.loads(payload)
+            except (EOFError, ValueError, TypeError):
+                break
+            offset = end
+            yield offset, record
+
+    def _apply(self, record):
+        op = record[0]
+        if op == "s":
+            MemoryStorage.save_snapshot(self, record[1], record[2])
+        elif op == "d":
+            MemoryStorage.drop_snapshot(self, record[1])
+        elif op == "n":
+            self._sequence = record[1] - 1
+            MemoryStorage.save_notice(self, record[2], record[3], record[4])
+        elif op == "x":
+            MemoryStorage.drop_notice(self, record[1], record[2], record[3])
+        elif op == "q":
+            self._sequence = max(self._sequence, record[1])
+        else:
+            raise RuntimeError(f"unknown log storage record {op!r}")
+
+    def _frame(self, record):
+        payload = marshal.dumps(record)
+        return self._HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+    def _open_segment(self, number):
+        path = self._path("segment", number)
+        created = not path.exists()
+        self._segment_number = number
+        self._segment = open(path, "ab")
+        if created:
+            self._sync_directory()
+
+    def _sync_directory(self):
+        if self._sync:
+            fd = os.open(str(self._directory), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def close(self):
+        super().close()
+        self._segment.close()
+        if self._compactor:
+            self._compactor.join()
+            self._compactor = None
+        self._check_compact_error()
+
+    def rollback(self):
+        self._pending = []
+        super().rollback()
+
+    def commit(self):
+        self._check_compact_error()
+        if self._pending:
+            self._pending.append(self._frame(("c",)))
+            self._segment.write(b"".join(self._pending))
+            self._segment.flush()
+            if self._sync:
+                os.fsync(self._segment.fileno())
+            self._pending = []
+        super().commit()
+        if self._segment.tell() >= self._segment_size:
+            self._rotate()
+            with self._lock:
+                closed = len(self._closed_segments)
+            if closed >= self._compact_segments and not (self._compactor and self._compactor.is_alive()):
+                self._start_compaction()
+
+    def compact(self):
+        """Fold all committed data into a new base file and wait until that's done."""
+        if self._pending:
+            raise RuntimeError("cannot compact log storage with uncommitted changes")
+        if self._compactor:
+            self._compactor.join()
+        self._rotate()
+        self._start_compaction()
+        self._compactor.join()
+        self._check_compact_error()
+
+    def _rotate(self):
+        self._segment.close()
+        with self._lock:
+            self._closed_segments.append(self._segment_number)
+        self._open_segment(self._segment_number + 1)
+
+    def _start_compaction(self):
+        # The base is written from a copy of the committed state, so that new
+        # changes may go on being appended to the active segment meanwhile.
+        with self._lock:
+            upto = self._closed_segments[-1]
+        snapshots = dict(self._snapshots)
+        notices = [(sequence, event_path, observer_path, method_name)
+                   for event_path, notices in self._notices.items()
+                   for sequence, (observer_path, method_name) in notices.items()]
+        self._compactor = threading.Thread(target=self._compact, args=(upto, snapshots, notices, self._sequence))
+        self._compactor.daemon = True
+        self._compactor.start()
+
+    def _compact(self, upto, snapshots, notices, sequence):
+        tmp_path = self._path("base", upto, ".tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                for handle_path, snapshot_data in snapshots.items():
+                    f.write(self._frame(("s", handle_path, snapshot_data)))
+                for notice in sorted(notices):
+                    f.write(self._frame(("n",) + notice))
+                # Sequences are never reused, even if the last notices were dropped.
+                f.write(self._frame(("q", sequence)))
+                f.write(self._frame(("c",)))
+                f.flush()
+                if self._sync:
+                    os.fsync(f.fileno())
+            os.replace(str(tmp_path), str(self._path("base", upto)))
+            self._sync_directory()
+        except Exception as e:
+            self._compact_error = e
+            if tmp_path.exists():
+                tmp_path.unlink()
+            return
+
+        # The new base is in place, so everything it covers may go.
+        with self._lock:
+            folded = [number for number in self._closed_segments if number <= upto]
+            self._closed_segments = [number for number in self._closed_segments if number > upto]
+        for number in folded:
+            self._path("segment", number).unlink()
+        for number in self._numbers("base"):
+            if number < upto:
+                self._path("base", number).unlink()
+
+    def _check_compact_error(self):
+        error = self._compact_error
+        if error is not None:
+            self._compact_error = None
+            raise RuntimeError(f"log storage compaction failed: {error}") from error
+
+    def save_snapshot(self, handle_path, snapshot_data):
+        super().save_snapshot(handle_path, snapshot_data)
+        self._pending.append(self._frame(("s", handle_path, snapshot_data)))
+
+    def drop_snapshot(self, handle_path):
+        super().drop_snapshot(handle_path)
+        self._pending.append(self._frame(("d", handle_path)))
+
+    def save_notice(self, event_path, observer_path, method_name):
+        super().save_notice(event_path, observer_path, method_name)
+        self._pending.append(self._frame(("n", self._sequence, event_path, observer_path, method_name)))
+
+    def drop_notice(self, event_path, observer_path, method_name):
+        super().drop_notice(event_path, observer_path, method_name)
+        self._pending.append(self._frame(("x", event_path, observer_path, method_name)))
+
+
+class _SimplePickler(pickle.Pickler):
+    """Pickler refusing anything but simple builtin types.
+
+    Pickle handles None, booleans, and exact instances of int, float, str, bytes,
+    tuple, list, dict, set and frozenset on its own, and asks reducer_override
+    about everything else, which is refused here.
+    """
+
+    def reducer_override(self, obj):
+        raise ValueError(f"cannot snapshot {type(obj).__name__} values: only simple builtin types are allowed")
+
+
+class PickleCodec:
+    """Snapshot codec that encodes data with pickle, accepting simple types only.
+
+    This is the default codec. Pickle is used for serialization so the value
+    remains portable across Python versions. Since Python 3.8 the data is
+    validated while it's pickled, in a single pass. Before that, marshal is
+    used as a separate validator, serializing the data twice on every save.
+    Snapshots saved by MarshalCodec are decoded as well.
+    """
+
+    def encode(self, data):
+        if sys.version_info < (3, 8):
+            # Use marshal as a validator, enforcing the use of simple types.
+            _ = marshal.dumps(data)
+            return pickle.dumps(data)
+        f = io.BytesIO()
+        _SimplePickler(f, pickle.DEFAULT_PROTOCOL).dump(data)
+        return f.getvalue()
+
+    def decode(self, raw_data):
+        if raw_data[:1] == MarshalCodec.TAG:
+            return MarshalCodec().decode(raw_data)
+        return pickle.loads(raw_data)
+
+
+class MarshalCodec:
+    """Snapshot codec that validates and encodes data in a single marshal pass.
+
+    Marshal only accepts simple builtin types, so encoding the data is also what
+    validates it. The encoded data is prefixed by a format tag and the marshal
+    format version, so that it may be evolved without breaking existing data.
+    Snapshots saved by PickleCodec are still decoded.
+
+    This is opt-in (see Framework). Marshal is faster than pickle, but it
+    doesn't share repeated strings, so snapshots are larger, and its format is
+    only guaranteed to be stable within a single Python version.
+    """
+
+    TAG = b"M"
+
+    # Version 4 of the marshal format has been stable since Python 3.4.
+    VERSION = 4
+
+    def __init__(self):
+        self._header = self.TAG + bytes([self.VERSION])
+
+    def encode(self, data):
+        return self._header + marshal.dumps(data, self.VERSION)
+
+    def decode(self, raw_data):
+        raw_data = bytes(raw_data)
+        if raw_data[:1] == self.TAG:
+            version = raw_data[1]
+            if version > marshal.version:
+                raise RuntimeError(f"cannot decode snapshot with marshal version {version}")
+            return marshal.loads(memoryview(raw_data)[2:])
+        # Pickle data starts with the PROTO opcode.
+        if raw_data[:1] == b"\x80":
+            return pickle.loads(raw_data)
+        raise RuntimeError("cannot decode snapshot with unknown format")
+
+
+class ChromeTrace:
+    """Writer of trace events in the Chrome trace-event format.
+
+    Events are written to the file as they're recorded, in the JSON array
+    format. If the process dies before the trace is closed, the array isn't
+    terminated, which trace viewers accept as well.
+    """
+
+    def __init__(self, filename):
+        self._file = open(filename, "w")
+        self._file.write("[")
+        self._separator = "\n"
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            self._file.write("\n]\n")
+            self._file.close()
+
+    @staticmethod
+    def clock():
+        """Return the current time in the microseconds expected by the format."""
+        return time.perf_counter() * 1e6
+
+    def span(self, name, category, start, args):
+        """Record a span for something that began at start and ends now."""
+        now = self.clock()
+        self._write({"name": name, "cat": category, "ph": "X", "ts": start, "dur": now - start, "args": args})
+
+    def instant(self, name, category, args):
+        self._write({"name": name, "cat": category, "ph": "i", "s": "t", "ts": self.clock(), "args": args})
+
+    def _write(self, event):
+        event["pid"] = self._pid
+        event["tid"] = threading.get_ident()
+        data = json.dumps(event)
+        with self._lock:
+            self._file.write(self._separator + data)
+            self._separator = ",\n"
+
+
+# Number of event keys reserved in storage at once.
+EVENT_KEY_BLOCK = 100
+
+# Number of patches saved for stored state before they're folded into a
+# new full snapshot (see Framework._save_stored_changes).
+STORED_PATCH_LIMIT = 20
 
 
-class Framework:
+class Framework(Object):
 
-    def __init__(self, data_path):
+    on = FrameworkEvents()
+
+    handle_kind = "framework"
+
+    def __init__(self, data_path, snapshot_codec=None, durability="strict", storage=None, parallel_workers=4):
+        """Create a framework persisting its data into the SQLite database at data_path.
+
+        Alternatively, a storage object implementing the same interface as
+        SQLiteStorage, such as MemoryStorage, may be provided directly, in
+        which case data_path and durability are ignored.
+
+        Snapshots are encoded with PickleCodec, unless another codec such as
+        MarshalCodec is provided as snapshot_codec.
+
+        Up to parallel_workers threads are used to notify observers that were
+        registered as parallel-safe (see observe).
+        """
         self._data_path = data_path
-        self._event_count = 0
-        self._observers = [] # [(observer, method_name, parent_path, event_key)]
+        self._observers = {} # {(emitter_path, event_kind): [(observer_path, method_name)]}
+        self._observed = set() # {(emitter_path, event_kind, observer_path, method_name)}
         self._observer = {}  # {observer_path: observer}
         self._type_registry = {} # {(parent_path, kind): cls}
         self._type_known = set() # {cls}
-
-        self._storage = SQLiteStorage(data_path)
+        self._dropped_notices = [] # [(event_path, observer_path, method_name)]
+        self._coalescing = 0
+        self._batching = False
+        self._coalesced_changes = {} # {StoredStateData: {key}}
+        self._stats = None # See enable_stats.
+        self._storage_stats = None
+        self._trace = None # See enable_tracing.
+        self._parallel = set() # {(emitter_path, event_kind, observer_path, method_name)}
+        self._patch_counts = {} # {handle_path: patches saved after the snapshot}
+        self._parallel_workers = parallel_workers
+        self._parallel_pool = None
+
+        self._codec = snapshot_codec or PickleCodec()
+        if storage is None:
+            storage = SQLiteStorage(data_path, durability)
+        self._storage = storage
+
+        super().__init__(self, None)
+
+        # The last reserved event key is persisted, so keys are never reused by
+        # later processes while events using them may still be deferred.
+        self.register_type(StoredStateData, None)
+        try:
+            self._stored = self.load_snapshot(Handle(None, StoredStateData.handle_kind, "_stored"))
+        except NoSnapshotError:
+            self._stored = StoredStateData(self, "_stored")
+        self._event_count = self._event_limit = self._stored["event_limit"] or 0
 
     def close(self):
+        if self._parallel_pool is not None:
+            self._parallel_pool.shutdown()
+            self._parallel_pool = None
+        self.disable_tracing()
         self._storage.close()
 
+    def enable_tracing(self, filename):
+        """Record the lifecycle of events as a Chrome trace in filename.
+
+        The trace holds spans for saving each emitted event and its notices,
+        for every pass reemitting events, each observer call, and dropping
+        the event once all observers are done with it, plus an instant event
+        with the deferral decision of each observer. Open it in a trace viewer
+        such as chrome://tracing or Perfetto.
+
+        Tracing is disabled by default, and costs next to nothing until enabled.
+        The trace is completed when tracing is disabled or the framework closed.
+        """
+        self.disable_tracing()
+        self._trace = ChromeTrace(filename)
+
+    def disable_tracing(self):
+        if self._trace is not None:
+            self._trace.close()
+            self._trace = None
+
+    def enable_stats(self):
+        """Start collecting counters about dispatching and storage, from zero.
+
+        Stats are disabled by default, and cost next to nothing until enabled.
+        See stats for what's collected.
+        """
+        self._stats = {
+            "emits": 0,
+            "notices_saved": 0,
+            "notices_dropped": 0,
+            "snapshots_saved": 0,
+            "snapshot_bytes_saved": 0,
+            "snapshots_loaded": 0,
+            "snapshot_bytes_loaded": 0,
+            "reemit_passes": 0,
+            "observers": {}, # {"observer_path.method_name": [calls, seconds]}
+        }
+        enable_storage_stats = getattr(self._storage, "enable_stats", None)
+        self._storage_stats = enable_storage_stats and enable_storage_stats()
+
+    def disable_stats(self):
+        self._stats = None
+        self._storage_stats = None
+        disable_storage_stats = getattr(self._storage, "disable_stats", None)
+        if disable_storage_stats:
+            disable_storage_stats()
+
+    def stats(self):
+        """Return a dict with the counters collected since stats were enabled.
+
+        Besides the number of emits, notices saved and dropped, snapshots saved
+        and loaded with their total size in bytes, and reemit passes, it holds
+        the calls made to each observer method and the total seconds spent in
+        them under "observers", and the statements executed per storage method
+        under "storage", if the storage counts them as SQLiteStorage does.
+        """
+        if self._stats is None:
+            raise RuntimeError("framework stats are not enabled")
+        stats = dict(self._stats)
+        stats["observers"] = {name: {"calls": calls, "seconds": seconds}
+                              for name, (calls, seconds) in self._stats["observers"].items()}
+        if self._storage_stats is not None:
+            stats["storage"] = dict(self._storage_stats)
+        return stats
+
     def commit(self):
+        _check_observer_thread("commit")
+        if self._batching:
+            # The batch commits everything once it's done.
+            return
+        # Give a chance for objects to persist pending data before the commit is made.
+        self._pre_commit()
+        self._drop_notices()
         self._storage.commit()
 
+    def _pre_commit(self):
+        """Notify the observers of the pre_commit event.
+
+        The event can't be deferred, so rather than going through storage as other
+        events do, it's delivered in memory straight to its observers. Nothing is
+        saved for it, and it doesn't take an event key.
+        """
+        observers = self._observers.get((self.on.handle.path, "pre_commit"))
+        if not observers:
+            return
+        event = PreCommitEvent(Handle(self.on, "pre_commit", None))
+        stats = self._stats
+        trace = self._trace
+        # Observers may be registered while others are notified.
+        for observer_path, method_name in list(observers):
+            custom_handler = getattr(self._observer.get(observer_path), method_name, None)
+            if not custom_handler:
+                continue
+            if stats is None and trace is None:
+                custom_handler(event)
+            else:
+                self._call_observer(stats, trace, custom_handler, event, f"{observer_path}.{method_name}")
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Group all changes made within the scope into a single transaction.
+
+        Snapshots and notices saved by emits within the scope, and stored state
+        changes, are only committed once the scope ends. Changed events of stored
+        state are coalesced as done by coalesce_changes, and calls to commit are
+        postponed until the end. Batches may be nested, in which case everything
+        is committed when the outermost one ends.
+
+        If the outermost scope ends with an error, the whole transaction is rolled
+        back, and stored state is restored from storage. Observers that were already
+        notified about events within the scope are not told about it, though.
+        """
+        if self._batching:
+            with self.coalesce_changes():
+                yield
+            return
+        self._batching = True
+        try:
+            with self.coalesce_changes():
+                yield
+        except BaseException:
+            self._batching = False
+            self._rollback()
+            raise
+        self._batching = False
+        self.commit()
+
+    def _rollback(self):
+        self._dropped_notices = []
+        self._storage.rollback()
+        # Patches may have been rolled back, so count them again when needed.
+        self._patch_counts = {}
+        # Reload stored state that holds changes which were rolled back.
+        for observer in list(self._observer.values()):
+            if isinstance(observer, StoredStateData) and observer.dirty:
+                try:
+                    observer.restore(self.load_snapshot(observer.handle)._cache)
+                except NoSnapshotError:
+                    observer.restore({})
+        # The key reservation may have been rolled back as well.
+        try:
+            self._stored = self.load_snapshot(self._stored.handle)
+        except NoSnapshotError:
+            self._stored = StoredStateData(self, "_stored")
+        self._event_limit = self._stored["event_limit"] or 0
+
+    @contextlib.contextmanager
+    def coalesce_changes(self):
+        """Coalesce the changed events of stored state within the scope.
+
+        Rather than emitting one changed event per change, each stored state that
+        changed within the scope emits a single changed event when the outermost
+        scope ends, listing the keys of all attributes that were changed. If the
+        scope ends with an error, pending notifications are discarded.
+        """
+        self._coalescing += 1
+        try:
+            yield
+        finally:
+            self._coalescing -= 1
+            if not self._coalescing:
+                changes = self._coalesced_changes
+                self._coalesced_changes = {}
+        # Only reached when the scope ended without errors.
+        if not self._coalescing:
+            for data, keys in changes.items():
+                data.on.changed.emit(sorted(keys))
+
+    def _next_event_key(self):
+        """Return the key for a new event.
+
+        Keys are reserved in blocks of EVENT_KEY_BLOCK, so the reservation is
+        only saved once per block rather than on every emitted event. It's
+        saved in the same transaction as the events using the keys, so either
+        both make it into storage or neither do.
+        """
+        _check_observer_thread("emit events")
+        self._event_count += 1
+        if self._event_count > self._event_limit:
+            # Other processes may have reserved keys since the reservation was loaded,
+            # so load it again within the transaction that saves the new one.
+            self._storage.begin()
+            self._reload_stored()
+            self._event_count = max(self._event_count, (self._stored["event_limit"] or 0) + 1)
+            self._event_limit = self._event_count + EVENT_KEY_BLOCK - 1
+            self._stored["event_limit"] = self._event_limit
+            self.save_snapshot(self._stored)
+            self._stored.dirty = False
+        return str(self._event_count)
+
+    def _reload_stored(self):
+        """Load the framework's own stored state again, as other processes may have changed it.
+
+        Must be called within a transaction, so that it stays as loaded until saved.
+        """
+        try:
+            self._stored = self.load_snapshot(self._stored.handle)
+        except NoSnapshotError:
+            pass
+
     def register_type(self, cls, parent, kind=None):
         if parent and not isinstance(parent, Handle):
             parent = parent.handle
@@ -341,11 +1501,99 @@ class Framework:
         if type(value) not in self._type_known:
             raise RuntimeError(f"cannot save {type(value).__name__} values before registering that type")
         data = value.snapshot()
-        # Use marshal as a validator, enforcing the use of simple types.
-        _ = marshal.dumps(data)
-        # Use pickle for serialization, so the value remains portable.
-        raw_data = pickle.dumps(data)
+        raw_data = self._codec.encode(data)
+        if self._stats is not None:
+            self._stats["snapshots_saved"] += 1
+            self._stats["snapshot_bytes_saved"] += len(raw_data)
         self._storage.save_snapshot(value.handle.path, raw_data)
+        if isinstance(value, StoredStateData):
+            # The full snapshot supersedes any patches saved before it.
+            self._drop_patches(value.handle.path)
+            value._changed.clear()
+
+    def _save_stored_changes(self, data):
+        """Save what changed in stored state since it was last saved.
+
+        Rather than rewriting all of the state, the changes are saved as a patch,
+        under the handle path of the state followed by "#" and the patch number.
+        Patches are applied on top of the full snapshot when it's loaded, and once
+        there are STORED_PATCH_LIMIT of them, the full state is saved again instead.
+
+        Changes are tracked per key of the stored attributes and of the dicts within
+        them, at any depth, so changing a single entry of a large dict only saves
+        that entry. Lists and sets are saved whole when they or anything within
+        them changes.
+        """
+        if not data._changed:
+            return
+        handle_path = data.handle.path
+        count = self._patch_counts.get(handle_path)
+        if count is None or count >= STORED_PATCH_LIMIT:
+            # The state was never saved, or this process doesn't know about it yet.
+            self.save_snapshot(data)
+            return
+        # The patch holds a (path, value) pair for each value set, and a (path,) tuple
+        # for each one deleted, where path holds the keys leading to the value.
+        patch = []
+        saved = set()
+        # Shorter paths first, so changes within values saved whole are skipped.
+        for path in sorted(data._changed, key=len):
+            if any(path[:i] in saved for i in range(1, len(path))):
+                continue
+            saved.add(path)
+            parent = data._cache
+            for key in path[:-1]:
+                parent = parent.get(key) if type(parent) is dict else None
+            if type(parent) is not dict:
+                # Changed through a value that's not part of the state anymore.
+                continue
+            key = path[-1]
+            if key in parent:
+                patch.append((path, parent[key]))
+            else:
+                patch.append((path,))
+        if not patch:
+            data._changed.clear()
+            return
+        raw_data = self._codec.encode(patch)
+        if self._stats is not None:
+            self._stats["snapshots_saved"] += 1
+            self._stats["snapshot_bytes_saved"] += len(raw_data)
+        self._storage.save_snapshot(f"{handle_path}#{count + 1}", raw_data)
+        self._patch_counts[handle_path] = count + 1
+        data._changed.clear()
+
+    def _load_patches(self, handle_path, data):
+        """Apply the patches saved for the stored state at handle_path to its data."""
+        count = 0
+        while True:
+            raw_data = self._storage.load_snapshot(f"{handle_path}#{count + 1}")
+            if not raw_data:
+                break
+            if self._stats is not None:
+                self._stats["snapshots_loaded"] += 1
+                self._stats["snapshot_bytes_loaded"] += len(raw_data)
+            for change in self._codec.decode(raw_data):
+                path = change[0]
+                parent = data
+                for key in path[:-1]:
+                    parent = parent[key]
+                if len(change) == 2:
+                    parent[path[-1]] = change[1]
+                else:
+                    parent.pop(path[-1], None)
+            count += 1
+        self._patch_counts[handle_path] = count
+
+    def _drop_patches(self, handle_path):
+        count = self._patch_counts.get(handle_path)
+        if count is None:
+            count = 0
+            while self._storage.load_snapshot(f"{handle_path}#{count + 1}"):
+                count += 1
+        for n in range(1, count + 1):
+            self._storage.drop_snapshot(f"{handle_path}#{n}")
+        self._patch_counts[handle_path] = 0
 
     def load_snapshot(self, handle):
         parent_path = None
@@ -357,7 +1605,12 @@ class Framework:
         raw_data = self._storage.load_snapshot(handle.path)
         if not raw_data:
             raise NoSnapshotError(handle.path)
-        data = pickle.loads(raw_data)
+        if self._stats is not None:
+            self._stats["snapshots_loaded"] += 1
+            self._stats["snapshot_bytes_loaded"] += len(raw_data)
+        data = self._codec.decode(raw_data)
+        if cls is StoredStateData:
+            self._load_patches(handle.path, data)
         obj = cls.__new__(cls)
         obj.framework = self
         obj.handle = handle
@@ -366,8 +1619,13 @@ class Framework:
 
     def drop_snapshot(self, handle):
         self._storage.drop_snapshot(handle.path)
+        parent_path = None
+        if handle.parent:
+            parent_path = handle.parent.path
+        if self._type_registry.get((parent_path, handle.kind)) is StoredStateData:
+            self._drop_patches(handle.path)
 
-    def observe(self, bound_event, observer):
+    def observe(self, bound_event, observer, parallel=False):
         """Register observer to be called when bound_event is emitted.
 
         The bound_event is generally provided as an attribute of the object that emits
@@ -385,6 +1643,18 @@ class Framework:
 
             framework.observe(someobj.something_happened, self)
 
+        Observers are notified in the order they were registered, except for
+        concurrent ones. Observers that are coroutine functions run concurrently
+        with each other, once all other observers of the event were notified, even
+        the ones registered after them (see Framework.reemit_async).
+
+        Observers registered with parallel set are run in a pool of threads along
+        with other parallel observers of the same event, while the ones that aren't
+        are still notified in order. Each of them gets its own copy of the event.
+        The setting only applies to bound_event, so the same method may be run in
+        parallel for one event and not for another. They must not emit events or
+        change stored state, as storage is only used from the thread running the
+        framework.
         """
         if not isinstance(bound_event, BoundEvent):
             raise RuntimeError(f'Framework.observe requires a BoundEvent as second parameter, got {bound_event}')
@@ -411,76 +1681,382 @@ class Framework:
 
         # TODO Validate that the method has the right signature here.
 
-        # TODO Prevent the exact same parameters from being registered more than once.
-
         self._observer[observer.handle.path] = observer
-        self._observers.append((observer.handle.path, method_name, emitter_path, event_kind))
+        # Observers are indexed by what they observe, so that emitting an event only
+        # needs to look at the observers interested in it.
+        key = (emitter_path, event_kind)
+        observers = self._observers.get(key)
+        if observers is None:
+            observers = self._observers[key] = []
+        # The same observer may be registered again, for example when an object
+        # is recreated under the same handle. It's still only notified once.
+        notice = (observer.handle.path, method_name)
+        subscription = key + notice
+        if subscription not in self._observed:
+            self._observed.add(subscription)
+            observers.append(notice)
+        if parallel:
+            self._parallel.add(subscription)
+        else:
+            self._parallel.discard(subscription)
 
     def _emit(self, event):
         """See BoundEvent.emit for the public way to call this."""
+        if self._save_event(event):
+            self._reemit(event.handle.path)
 
-        # Save the event for all known observers before the first notification
-        # takes place, so that either everyone interested sees it, or nobody does.
-        self.save_snapshot(event)
+    async def _emit_async(self, event):
+        """See BoundEvent.emit_async for the public way to call this."""
+        if self._save_event(event):
+            await self._reemit_async(event.handle.path)
+
+    def _save_event(self, event):
+        """Save event and its notices for all observers, and return whether there are any."""
         event_path = event.handle.path
         event_kind = event.handle.kind
         parent_path = event.handle.parent.path
-        notices = []
-        for observer_path, method_name, _parent_path, _event_kind in self._observers:
-            if _parent_path != parent_path:
-                continue
-            if _event_kind and _event_kind != event_kind:
-                continue
-            # Again, only commit this after all notices are saved.
-            self._storage.save_notice(event_path, observer_path, method_name)
-        self._reemit(event_path)
-
-    def reemit(self):
+        observers = self._observers.get((parent_path, event_kind))
+        if self._stats is not None:
+            self._stats["emits"] += 1
+        if not observers:
+            # Nobody would ever be notified about it, so there's nothing to save.
+            return False
+        trace = self._trace
+        # Save the event for all known observers before the first notification
+        # takes place, so that either everyone interested sees it, or nobody does.
+        if trace is not None:
+            start = trace.clock()
+        self.save_snapshot(event)
+        if trace is not None:
+            trace.span("save_snapshot", "storage", start, {"event": event_path})
+            start = trace.clock()
+        # Again, only commit this after all notices are saved.
+        self._storage.save_notices([(event_path, observer_path, method_name)
+                                    for observer_path, method_name in observers])
+        if trace is not None:
+            trace.span("save_notices", "storage", start, {"event": event_path, "notices": len(observers)})
+        if self._stats is not None:
+            self._stats["notices_saved"] += len(observers)
+        return True
+
+    def reemit(self, max_events=None, max_seconds=None):
         """Reemit previously deferred events to the observers that deferred them.
 
         Only the specific observers that have previously deferred the event will be
         notified again. Observers that asked to be notified about events after it's
         been first emitted won't be notified, as that would mean potentially observing
         events out of order.
+
+        The pass may be limited to notifying at most max_events observers, or to
+        max_seconds of wall time, in which case it stops before the next notice
+        once the budget is spent. The next call with a budget then resumes from
+        that notice, even if made by a later process, so earlier notices are only
+        notified again once the pass reaches the end of the backlog. A call without
+        a budget always goes over the whole backlog from the beginning. Returns the
+        number of notices that were left for later.
+
+        Observers that are coroutine functions are run concurrently once all other
+        observers of the event were notified, in an event loop created for the pass.
+        Within a running event loop, use reemit_async instead.
+        """
+        return self._reemit(max_events=max_events, max_seconds=max_seconds)
+
+    async def reemit_async(self, max_events=None, max_seconds=None):
+        """Reemit previously deferred events as reemit does, within the running event loop.
+
+        All observers of an event that are coroutine functions are run concurrently,
+        after any other observers of the event are notified in order. Each of them
+        gets its own copy of the event, so it may decide whether to defer it on its
+        own. Notices are then dropped or kept in order, once all of them are done.
+        If any of them fails, the first error is raised after the others are done.
         """
-        self._reemit()
+        return await self._reemit_async(max_events=max_events, max_seconds=max_seconds)
 
-    def _reemit(self, single_event_path=None):
+    def _reemit(self, single_event_path=None, max_events=None, max_seconds=None):
+        steps = self._reemit_steps(single_event_path, max_events, max_seconds)
+        # Async observers of all events in the pass run in the same event loop,
+        # created once the first of them is found.
+        loop = None
+        try:
+            calls = next(steps)
+            while True:
+                if not any(inspect.iscoroutine(call) for call in calls):
+                    calls = steps.send(_wait_observers(calls))
+                    continue
+                if loop is None:
+                    try:
+                        asyncio.get_running_loop()
+                    except RuntimeError:
+                        loop = asyncio.new_event_loop()
+                    else:
+                        for call in calls:
+                            if inspect.iscoroutine(call):
+                                call.close()
+                        calls = steps.throw(RuntimeError(
+                            "cannot notify async observers from a running event loop; use emit_async or reemit_async"))
+                        continue
+                calls = steps.send(loop.run_until_complete(_gather_observers(calls)))
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            if loop is not None:
+                try:
+                    loop.run_until_complete(loop.shutdown_asyncgens())
+                finally:
+                    loop.close()
+
+    async def _reemit_async(self, single_event_path=None, max_events=None, max_seconds=None):
+        steps = self._reemit_steps(single_event_path, max_events, max_seconds)
+        try:
+            calls = next(steps)
+            while True:
+                calls = steps.send(await _gather_observers(calls))
+        except StopIteration as stop:
+            return stop.value
+
+    def _reemit_steps(self, single_event_path, max_events, max_seconds):
+        """Reemit notices, yielding the calls to concurrent observers for the caller to wait for.
+
+        Calls are coroutines of async observers, and futures of parallel observers
+        already running in threads. The caller must run together all the ones
+        yielded at once, and send back what each of them returned or raised. See
+        _reemit and _reemit_async.
+        """
+        # Notices that were handled are dropped in bulk, once per event. Anything
+        # still pending from an outer _reemit call is dropped first, so that a
+        # nested call never sees notices that were already handled.
+        self._drop_notices()
+        # Lock out other processes before reading notices, so they don't handle
+        # the same ones concurrently.
+        self._storage.begin()
+        stats = self._stats
+        if stats is not None:
+            stats["reemit_passes"] += 1
+        trace = self._trace
+        if trace is not None:
+            pass_start = trace.clock()
+        # A full pass with a budget resumes after the last notice handled by a previous
+        # pass that ran out of budget. Passes without one start from the beginning, so
+        # they drain the whole backlog. Passes for a single event are made as it's
+        # emitted, and never stop early.
+        cursor = 0
+        if not single_event_path and (max_events is not None or max_seconds is not None):
+            self._reload_stored()
+            cursor = self._stored["reemit_cursor"] or 0
+        if max_seconds is not None:
+            deadline = time.monotonic() + max_seconds
+        count = 0
+        sequence = cursor
+        remaining = 0
         last_event_path = None
         deferred = True
-        for event_path, observer_path, method_name in self._storage.notices(single_event_path):
-            event_handle = Handle.from_path(event_path)
-
-            if last_event_path != event_path:
-                if not deferred:
-                    self._storage.drop_snapshot(last_event_path)
-                last_event_path = event_path
-                deferred = False
+        pending = [] # [(notice, event, coroutine or future)] for concurrent observers of the current event.
+        try:
+            for sequence, event_path, observer_path, method_name in self._storage.sequenced_notices(single_event_path, cursor):
+                if ((max_events is not None and count >= max_events) or
+                        (max_seconds is not None and time.monotonic() >= deadline)):
+                    if pending:
+                        deferred = (yield from self._settle_pending(pending, trace)) or deferred
+                    self._drop_notices()
+                    remaining = self._storage.count_notices(single_event_path, sequence - 1)
+                    if last_event_path == event_path:
+                        # Stopped in the middle of the event, so it's still needed.
+                        deferred = True
+                    break
+                count += 1
+                if last_event_path != event_path:
+                    if pending:
+                        deferred = (yield from self._settle_pending(pending, trace)) or deferred
+                    self._drop_notices()
+                    if not deferred:
+                        self._drop_event_snapshot(last_event_path)
+                    # Notices for the first event of a resumed pass may have been
+                    # deferred by the previous pass, which still need the event.
+                    deferred = False
+                    if last_event_path is None and cursor:
+                        deferred = self._storage.count_notices(event_path) > self._storage.count_notices(event_path, cursor)
+                    last_event_path = event_path
+                    # The event is restored once for all of its observers in this pass.
+                    # Each observer still gets to decide on its own whether to defer it.
+                    event_handle = Handle.from_path(event_path)
+                    try:
+                        event = self.load_snapshot(event_handle)
+                    except NoTypeError:
+                        event = None
+                    # Observers are run in parallel or not per event they observe.
+                    parent = event_handle.parent
+                    subscription = (parent.path if parent else None, event_handle.kind)
+
+                if event is None:
+                    self._dropped_notices.append((event_path, observer_path, method_name))
+                    continue
+
+                event.deferred = False
+                observer = self._observer.get(observer_path)
+                if observer:
+                    custom_handler = getattr(observer, method_name, None)
+                    if custom_handler and inspect.iscoroutinefunction(custom_handler):
+                        # Run concurrently with the other async observers of the event, once
+                        # all of its notices were seen, each one with its own copy of it.
+                        observer_event = copy.copy(event)
+                        if stats is None and trace is None:
+                            coroutine = custom_handler(observer_event)
+                        else:
+                            coroutine = self._call_observer_async(stats, trace, custom_handler, observer_event,
+                                                                  f"{observer_path}.{method_name}")
+                        pending.append(((event_path, observer_path, method_name), observer_event, coroutine))
+                        continue
+                    if custom_handler and subscription + (observer_path, method_name) in self._parallel:
+                        # Started right away in the pool, and waited for along with async observers.
+                        observer_event = copy.copy(event)
+                        pool = self._get_parallel_pool()
+                        if stats is None and trace is None:
+                            future = pool.submit(custom_handler, observer_event)
+                        else:
+                            future = pool.submit(self._call_observer, stats, trace, custom_handler, observer_event,
+                                                 f"{observer_path}.{method_name}")
+                        pending.append(((event_path, observer_path, method_name), observer_event, future))
+                        continue
+                    if custom_handler:
+                        if stats is None and trace is None:
+                            custom_handler(event)
+                        else:
+                            self._call_observer(stats, trace, custom_handler, event, f"{observer_path}.{method_name}")
+
+                if trace is not None:
+                    trace.instant("deferral", "dispatch", {"event": event_path, "observer": observer_path,
+                                                           "method": method_name, "deferred": event.deferred})
+                if event.deferred:
+                    deferred = True
+                else:
+                    self._dropped_notices.append((event_path, observer_path, method_name))
+            if pending:
+                deferred = (yield from self._settle_pending(pending, trace)) or deferred
+        finally:
+            # Concurrent observers that were not waited for if something failed. Their
+            # notices are kept, but threads already running must finish before moving on.
+            for notice, event, call in pending:
+                if inspect.iscoroutine(call):
+                    call.close()
+                else:
+                    call.cancel()
+            concurrent.futures.wait([call for notice, event, call in pending if not inspect.iscoroutine(call)])
+            self._drop_notices()
 
-            try:
-                event = self.load_snapshot(event_handle)
-            except NoTypeError:
-                self._storage.drop_notice(event_path, observer_path, method_name)
+        if not deferred:
+            self._drop_event_snapshot(last_event_path)
+        if not single_event_path:
+            self._save_reemit_cursor(sequence - 1 if remaining else 0)
+        if trace is not None:
+            trace.span("reemit", "dispatch", pass_start, {"event": single_event_path, "remaining": remaining})
+        return remaining
+
+    def _settle_pending(self, pending, trace):
+        """Wait for the concurrent observers of an event, and handle their notices in order.
+
+        Returns whether any of them deferred the event. Notices of observers that
+        failed are kept, and the first error is raised once all of them are done.
+        """
+        results = yield [call for notice, event, call in pending]
+        settled = pending[:]
+        del pending[:]
+        deferred = False
+        error = None
+        for ((event_path, observer_path, method_name), event, call), result in zip(settled, results):
+            if isinstance(result, BaseException):
+                if error is None:
+                    error = result
                 continue
-
-            event.deferred = False
-            observer = self._observer.get(observer_path)
-            if observer:
-                custom_handler = getattr(observer, method_name, None)
-                if custom_handler:
-                    custom_handler(event)
-
+            if trace is not None:
+                trace.instant("deferral", "dispatch", {"event": event_path, "observer": observer_path,
+                                                       "method": method_name, "deferred": event.deferred})
             if event.deferred:
                 deferred = True
             else:
-                self._storage.drop_notice(event_path, observer_path, method_name)
+                self._dropped_notices.append((event_path, observer_path, method_name))
+        if error is not None:
+            raise error
+        return deferred
+
+    def _get_parallel_pool(self):
+        if self._parallel_pool is None:
+            self._parallel_pool = concurrent.futures.ThreadPoolExecutor(
+                self._parallel_workers, thread_name_prefix="framework-observer", initializer=_init_observer_thread)
+        return self._parallel_pool
+
+    def _save_reemit_cursor(self, cursor):
+        if not cursor and not self._stored["reemit_cursor"]:
+            return
+        # The cursor is saved along with the key reservation, which other processes
+        # may have extended since it was loaded, so it's saved over what's stored now.
+        self._storage.begin()
+        self._reload_stored()
+        if cursor != (self._stored["reemit_cursor"] or 0):
+            self._stored["reemit_cursor"] = cursor
+            self.save_snapshot(self._stored)
+            self._stored.dirty = False
+
+    def _drop_event_snapshot(self, event_path):
+        trace = self._trace
+        if trace is None:
+            self._storage.drop_snapshot(event_path)
+        else:
+            start = trace.clock()
+            self._storage.drop_snapshot(event_path)
+            trace.span("drop_snapshot", "storage", start, {"event": event_path})
 
-        if not deferred:
-            self._storage.drop_snapshot(last_event_path)
+    def _call_observer(self, stats, trace, handler, event, name):
+        """Call handler with event, recording the call in stats and trace under name."""
+        start = time.perf_counter()
+        try:
+            handler(event)
+        finally:
+            self._record_observer_call(stats, trace, event, name, start)
+
+    async def _call_observer_async(self, stats, trace, handler, event, name):
+        """Await handler with event, recording the call in stats and trace under name."""
+        start = time.perf_counter()
+        try:
+            await handler(event)
+        finally:
+            self._record_observer_call(stats, trace, event, name, start)
+
+    def _record_observer_call(self, stats, trace, event, name, start):
+        seconds = time.perf_counter() - start
+        if stats is not None:
+            observers = stats["observers"]
+            calls, total = observers.get(name, (0, 0.0))
+            observers[name] = [calls + 1, total + seconds]
+        if trace is not None:
+            trace.span(name, "observer", start * 1e6, {"event": event.handle.path})
+
+    def _drop_notices(self):
+        if self._dropped_notices:
+            if self._stats is not None:
+                self._stats["notices_dropped"] += len(self._dropped_notices)
+            self._storage.drop_notices(self._dropped_notices)
+            self._dropped_notices = []
 
 
 class StoredStateChanged(EventBase):
-    pass
+    """Emitted when stored state changes.
+
+    The keys attribute holds the sorted names of the stored attributes that
+    changed, which is more than one when changes were coalesced (see
+    Framework.coalesce_changes).
+    """
+
+    def __init__(self, handle, keys=()):
+        super().__init__(handle)
+        self.keys = list(keys)
+
+    def snapshot(self):
+        return {"keys": self.keys}
+
+    def restore(self, snapshot):
+        super().restore(snapshot)
+        # Events deferred before keys were recorded have no snapshot data.
+        self.keys = snapshot["keys"] if snapshot else []
 
 class StoredStateEvents(EventsBase):
     changed = Event(StoredStateChanged)
@@ -492,21 +2068,50 @@ class StoredStateData(Object):
     def __init__(self, parent, attr_name):
         super().__init__(parent, attr_name)
         self._cache = {}
+        self._changed = set() # {path} changed since the state was last saved, see mark_changed.
+        self.dirty = False
 
     def __getitem__(self, key):
         return self._cache.get(key)
 
     def __setitem__(self, key, value):
+        _check_observer_thread("change stored state")
         self._cache[key] = value
+        self._changed.add((key,))
+        self.dirty = True
 
     def __contains__(self, key):
         return key in self._cache
 
+    def mark_changed(self, key, path=None):
+        """Record that the stored attribute key changed and notify observers.
+
+        If only part of the attribute value changed, path is the tuple of keys
+        leading to that part, starting with key itself.
+        """
+        _check_observer_thread("change stored state")
+        self._changed.add(path or (key,))
+        self.dirty = True
+        framework = self.framework
+        if framework._coalescing:
+            framework._coalesced_changes.setdefault(self, set()).add(key)
+        else:
+            self.on.changed.emit([key])
+
     def snapshot(self):
         return self._cache
 
     def restore(self, snapshot):
         self._cache = snapshot
+        self._changed = set()
+        self.dirty = False
+
+    def on_pre_commit(self, event):
+        # Changes are only persisted here, once per commit, rather than
+        # on every change made to the state.
+        if self.dirty:
+            self.framework._save_stored_changes(self)
+            self.dirty = False
 
 class BoundStoredState:
 
@@ -514,38 +2119,41 @@ class BoundStoredState:
         parent.framework.register_type(StoredStateData, parent)
 
         handle = Handle(parent, StoredStateData.handle_kind, attr_name)
-        try:
-            data = parent.framework.load_snapshot(handle)
-        except NoSnapshotError:
-            data = StoredStateData(parent, attr_name)
+        # Changes are only saved on commit, so an object created again under the
+        # same handle must take over the ones still pending rather than lose them.
+        data = parent.framework._observer.get(handle.path)
+        if not (isinstance(data, StoredStateData) and data.dirty):
+            try:
+                data = parent.framework.load_snapshot(handle)
+            except NoSnapshotError:
+                data = StoredStateData(parent, attr_name)
 
         self.__dict__["_data"] = data
         self.__dict__["_attr_name"] = attr_name
 
+        parent.framework.observe(parent.framework.on.pre_commit, data.on_pre_commit)
+
     def __getattr__(self, key):
         # "on" is the only reserved key that can't be used in the data map.
         if key == "on":
             return self._data.on
         if key not in self._data:
             raise AttributeError(f"attribute '{key}' is not stored")
-        return _wrap_stored(self._data, self._data[key])
+        return _wrap_stored(self._data, self._data[key], (key,))
 
     def __setattr__(self, key, value):
         if key == "on":
             raise AttributeError(f"attribute 'on' is reserved and cannot be set")
+        _check_observer_thread("change stored state")
 
         value = _unwrap_stored(self._data, value)
 
         if not isinstance(value, (type(None), int, str, bytes, list, dict, set)):
             raise AttributeError(f"attribute '{key}' cannot be set to {type(value).__name__}: must be int/dict/list/etc")
 
+        # The snapshot itself is only saved on the framework's pre-commit event.
         self._data[key] = _unwrap_stored(self._data, value)
-        self._data.framework.save_snapshot(self._data)
-        self.on.changed.emit()
-
-        # TODO Saving a snapshot on every change is not efficient. Instead, the
-        # the framework should offer a pre-commit event that the state can monitor
-        # and save itself at the right time if changes are pending.
+        self._data.mark_changed(key)
 
 
 class StoredState:
@@ -579,14 +2187,19 @@ class StoredState:
         return bound
 
 
-def _wrap_stored(parent_data, value):
+def _wrap_stored(parent_data, value, path, whole=False):
+    """Wrap value found at path within the stored attribute path[0].
+
+    Changes within the value are recorded at path + (key,) for dicts, unless whole
+    is set, and at path itself otherwise (see StoredStateData.mark_changed).
+    """
     t = type(value)
     if t is dict:
-        return StoredDict(parent_data, value)
+        return StoredDict(parent_data, value, path, whole)
     if t is list:
-        return StoredList(parent_data, value)
+        return StoredList(parent_data, value, path)
     if t is set:
-        return StoredSet(parent_data, value)
+        return StoredSet(parent_data, value, path)
     return value
 
 def _unwrap_stored(parent_data, value):
@@ -598,20 +2211,29 @@ def _unwrap_stored(parent_data, value):
 
 class StoredDict(collections.MutableMapping):
 
-    def __init__(self, stored_data, under):
+    def __init__(self, stored_data, under, path, whole=False):
         self._stored_data = stored_data
         self._under = under
+        self._path = path
+        self._whole = whole
+
+    def _key_path(self, key):
+        if self._whole:
+            return self._path
+        return self._path + (key,)
 
     def __getitem__(self, key):
-        return _wrap_stored(self._stored_data, self._under[key])
+        return _wrap_stored(self._stored_data, self._under[key], self._key_path(key), self._whole)
 
     def __setitem__(self, key, value):
+        _check_observer_thread("change stored state")
         self._under[key] = _unwrap_stored(self._stored_data, value)
-        self._stored_data.on.changed.emit()
+        self._stored_data.mark_changed(self._path[0], self._key_path(key))
 
     def __delitem__(self, key):
+        _check_observer_thread("change stored state")
         del self._under[key]
-        self._stored_data.on.changed.emit()
+        self._stored_data.mark_changed(self._path[0], self._key_path(key))
 
     def __iter__(self):
         return self._under.__iter__()
@@ -622,46 +2244,57 @@ class StoredDict(collections.MutableMapping):
 
 class StoredList(collections.MutableSequence):
 
-    def __init__(self, stored_data, under):
+    # Indexes shift as items are inserted and deleted, so any change within
+    # the list is recorded as a change of the whole list.
+
+    def __init__(self, stored_data, under, path):
         self._stored_data = stored_data
         self._under = under
+        self._path = path
 
     def __getitem__(self, index):
-        return _wrap_stored(self._stored_data, self._under[index])
+        return _wrap_stored(self._stored_data, self._under[index], self._path, True)
 
     def __setitem__(self, index, value):
+        _check_observer_thread("change stored state")
         self._under[index] = _unwrap_stored(self._stored_data, value)
-        self._stored_data.on.changed.emit()
+        self._stored_data.mark_changed(self._path[0], self._path)
 
     def __delitem__(self, index):
+        _check_observer_thread("change stored state")
         del self._under[index]
-        self._stored_data.on.changed.emit()
+        self._stored_data.mark_changed(self._path[0], self._path)
 
     def __len__(self):
         return len(self._under)
 
     def insert(self, index, value):
+        _check_observer_thread("change stored state")
         self._under.insert(index, value)
-        self._stored_data.on.changed.emit()
+        self._stored_data.mark_changed(self._path[0], self._path)
 
     def append(self, value):
+        _check_observer_thread("change stored state")
         self._under.append(value)
-        self._stored_data.on.changed.emit()
+        self._stored_data.mark_changed(self._path[0], self._path)
 
 
 class StoredSet(collections.MutableSet):
 
-    def __init__(self, stored_data, under):
+    def __init__(self, stored_data, under, path):
         self._stored_data = stored_data
         self._under = under
+        self._path = path
 
     def add(self, key):
+        _check_observer_thread("change stored state")
         self._under.add(key)
-        self._stored_data.on.changed.emit()
+        self._stored_data.mark_changed(self._path[0], self._path)
 
     def discard(self, key):
+        _check_observer_thread("change stored state")
         self._under.discard(key)
-        self._stored_data.on.changed.emit()
+        self._stored_data.mark_changed(self._path[0], self._path)
 
     def __contains__(self, key):
         return key in self._under